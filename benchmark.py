@@ -0,0 +1,384 @@
+import os
+import json
+import time
+import resource
+import tempfile
+from copy import deepcopy
+from functools import partial
+
+import numpy as np
+import torch
+
+from dataset import EEGDataset
+from layers import GeneralConv, MinibatchStddev, SelfAttention
+from losses import generator_loss, discriminator_loss
+from network import Generator, Discriminator, MultiDiscriminator, Unet
+from synthetic_data import write_corpus
+from torch_utils import Plugin
+from train import main as train_main, default_params as train_default_params, need_arg_classes
+from utils import cudize, resample_signal, simple_argparser, parse_config
+
+default_params = dict(
+    output='benchmark.json',
+    baseline='',  # a previous output of this script
+    threshold=0.1,  # relative slowdown (compared to the baseline) that is reported as a regression
+    suites=['networks', 'losses', 'layers'],  # and 'training' for the end to end run on a synthetic corpus
+    networks=['Generator', 'Discriminator', 'MultiDiscriminator', 'Unet'],
+    loss_types=['wgan_gp', 'wgan_theirs', 'hinge', 'rsgan', 'rasgan', 'rahinge'],
+    depths=[],  # empty means every depth
+    alphas=[0.5, 1.0],
+    checkpoint_depths=[],  # the networks are also timed with the blocks of these depths checkpointed
+    batch_size=8,
+    repeats=5,
+    warmup=1,
+    random_seed=1373,
+    num_channels=5,
+    initial_kernel_size=32,
+    latent_size=256,
+    fmap_base=1024,
+    fmap_max=256,
+    fmap_min=64,
+    kernel_size=3,
+    equalized=True,
+    spectral=False,
+    act_norm='pixel',
+    dropout=0.2,
+    group_size=4,
+    temporal_groups_per_windows=[1, 2, 4],
+    training_dir='',  # empty means a temporary directory, the synthetic corpus is reused if it already exists
+    training_depths=2,  # runs depth 0 and then transition + stabilization of depths 1..training_depths
+    training_phase_kimg=2.0,
+    training_minibatch_size=32,
+    training_autotune=False,  # let DepthManager pick the minibatch size of each depth
+    corpus_files=8,
+    corpus_duration=600.0,
+    corpus_format='mat',
+)
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def peak_memory_mb():
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # process wide peak in linux
+
+
+def reset_peak_memory():
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+
+def saved_tensors_mb(forward_fn):
+    """what autograd keeps around for the backward pass of forward_fn (parameters included)"""
+    storages = {}
+
+    def pack(t):
+        storages[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        forward_fn()
+    return sum(storages.values()) / 2 ** 20
+
+
+def summarize(times):
+    times = np.array(times)
+    return {'median': float(np.median(times)), 'min': float(times.min()), 'mean': float(times.mean())}
+
+
+def time_forward_backward(forward_fn, repeats, warmup, zero_grad_fn=None):
+    forward_times = []
+    backward_times = []
+    for i in range(warmup + repeats):
+        if zero_grad_fn is not None:
+            zero_grad_fn()
+        synchronize()
+        start = time.perf_counter()
+        out = forward_fn()
+        synchronize()
+        middle = time.perf_counter()
+        out.sum().backward()
+        synchronize()
+        end = time.perf_counter()
+        if i >= warmup:
+            forward_times.append(middle - start)
+            backward_times.append(end - middle)
+    return {'forward': summarize(forward_times), 'backward': summarize(backward_times)}
+
+
+def time_call(fn, repeats, warmup):
+    times = []
+    for i in range(warmup + repeats):
+        synchronize()
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def signal_lengths(params):
+    ratios = np.cumprod([1.0] + [u / d for u, d in zip(EEGDataset.progression_scale_up,
+                                                         EEGDataset.progression_scale_down)])
+    return [int(params['initial_kernel_size'] * r) for r in ratios]
+
+
+def shared_model_params(params):
+    return dict(initial_kernel_size=params['initial_kernel_size'], num_rgb_channels=params['num_channels'],
+                fmap_base=params['fmap_base'], fmap_max=params['fmap_max'], fmap_min=params['fmap_min'],
+                kernel_size=params['kernel_size'], self_attention_layers=[],
+                progression_scale_up=EEGDataset.progression_scale_up,
+                progression_scale_down=EEGDataset.progression_scale_down, residual=False, separable=False,
+                equalized=params['equalized'], init='kaiming_normal', act_alpha=0.2, num_classes=0, deep=False)
+
+
+def create_network(name, params):
+    shared = shared_model_params(params)
+    if name == 'Generator':
+        return Generator(**shared, z_distribution='normal', spectral=params['spectral'],
+                         latent_size=params['latent_size'], dropout=params['dropout'], act_norm=params['act_norm'])
+    if name == 'Discriminator':
+        return Discriminator(**shared, spectral=params['spectral'], dropout=params['dropout'],
+                             group_size=params['group_size'])
+    if name == 'MultiDiscriminator':
+        return MultiDiscriminator(**shared, spectral=params['spectral'], dropout=params['dropout'],
+                                  group_size=params['group_size'])
+    if name == 'Unet':
+        return Unet(params['num_channels'], params['num_channels'], params['latent_size'], False, params['equalized'],
+                    params['spectral'], 'kaiming_normal', 0.2, params['dropout'], 0, params['act_norm'], False,
+                    EEGDataset.progression_scale_up, EEGDataset.progression_scale_down, 'normal', True,
+                    params['fmap_base'], params['fmap_min'], params['fmap_max'], 0, [], params['kernel_size'],
+                    initial_kernel_size=params['initial_kernel_size'])
+    raise ValueError('invalid network: {}'.format(name))
+
+
+def network_forward(name, net, batch_size, num_channels, seq_len, latent_size):
+    if name == 'Generator':
+        z = cudize(torch.randn(batch_size, latent_size))
+        return lambda: net(z)[0]['x']
+    x = cudize(torch.randn(batch_size, num_channels, seq_len))
+    if name == 'Discriminator':
+        return lambda: net(x)[0]
+    if name == 'MultiDiscriminator':
+        return lambda: net(x)
+    z = cudize(torch.randn(batch_size, latent_size))
+    return lambda: net(x, None, z)
+
+
+def depths_to_run(params, max_depth):
+    if params['depths']:
+        return [d for d in params['depths'] if d <= max_depth]
+    return list(range(max_depth + 1))
+
+
+def set_checkpoint_depths(net, checkpoint_depths):
+    for m in net.modules():
+        if isinstance(m, (Generator, Discriminator)):
+            m.checkpoint_depths = set(checkpoint_depths)
+
+
+def bench_networks(params):
+    results = {}
+    seq_lens = signal_lengths(params)
+    for name in params['networks']:
+        net = cudize(create_network(name, params)).train()
+        max_depth = len(net.blocks) - 1 if isinstance(net, Unet) else len(seq_lens) - 1
+        # with checkpointing it's a memory / time trade-off, the saved tensors go down and the backward pass gets slower
+        variants = [name] + (['{}+checkpoint'.format(name)] if params['checkpoint_depths'] and name != 'Unet' else [])
+        for variant in variants:
+            set_checkpoint_depths(net, params['checkpoint_depths'] if variant != name else [])
+            for depth in depths_to_run(params, max_depth):
+                for alpha in params['alphas']:
+                    if depth == 0 and alpha != 1.0:
+                        continue
+                    net.depth = depth
+                    net.alpha = alpha
+                    forward_fn = network_forward(name, net, params['batch_size'], params['num_channels'],
+                                                 seq_lens[depth], params['latent_size'])
+                    timings = time_forward_backward(forward_fn, params['repeats'], params['warmup'], net.zero_grad)
+                    timings['saved_tensors'] = {'saved_mb': saved_tensors_mb(forward_fn)}
+                    for phase, summary in timings.items():
+                        results['{}/depth={}/alpha={}/{}'.format(variant, depth, alpha, phase)] = summary
+                    print(variant, depth, alpha, timings['forward']['median'], timings['backward']['median'],
+                          timings['saved_tensors']['saved_mb'])
+    return results
+
+
+def bench_losses(params):
+    results = {}
+    seq_lens = signal_lengths(params)
+    generator = cudize(create_network('Generator', params)).train()
+    discriminator = cudize(create_network('Discriminator', params)).train()
+    for depth in depths_to_run(params, len(seq_lens) - 1):
+        generator.depth = discriminator.depth = depth
+        generator.alpha = discriminator.alpha = 1.0
+        real = {'x': cudize(torch.randn(params['batch_size'], params['num_channels'], seq_lens[depth]))}
+        z = {'z': cudize(torch.randn(params['batch_size'], params['latent_size']))}
+        for loss_type in params['loss_types']:
+            d_loss = partial(discriminator_loss, discriminator, generator, real, z, loss_type=loss_type,
+                             iwass_drift_epsilon=0.001, grad_lambda=10.0, iwass_target=1.0)
+            g_loss = partial(generator_loss, discriminator, generator, real, z, loss_type=loss_type,
+                             random_multiply=False)
+            for loss_name, loss_fn in (('discriminator_loss', d_loss), ('generator_loss', g_loss)):
+                timings = time_forward_backward(loss_fn, params['repeats'], params['warmup'])
+                for phase, summary in timings.items():
+                    results['{}/{}/depth={}/{}'.format(loss_name, loss_type, depth, phase)] = summary
+                print(loss_name, loss_type, depth, timings['forward']['median'], timings['backward']['median'])
+    return results
+
+
+def bench_layers(params):
+    results = {}
+    seq_lens = signal_lengths(params)
+    batch_size = params['batch_size']
+    channels = params['fmap_max']
+    for depth in depths_to_run(params, len(seq_lens) - 2):
+        up = EEGDataset.progression_scale_up[depth]
+        down = EEGDataset.progression_scale_down[depth]
+        x = cudize(torch.randn(batch_size, channels, seq_lens[depth]))
+        for exact in (False, True):
+            name = 'resample_signal{}'.format('_exact' if exact else '')
+            x = cudize(torch.randn(batch_size, channels, seq_lens[depth]))
+            results['{}/up/depth={}'.format(name, depth)] = time_call(
+                lambda: resample_signal(x, down, up, exact=exact), params['repeats'], params['warmup'])
+            x = cudize(torch.randn(batch_size, channels, seq_lens[depth + 1]))
+            results['{}/down/depth={}'.format(name, depth)] = time_call(
+                lambda: resample_signal(x, up, down, exact=exact), params['repeats'], params['warmup'])
+    for depth in depths_to_run(params, len(seq_lens) - 1):
+        x = cudize(torch.randn(batch_size, channels, seq_lens[depth], requires_grad=True))
+        for temporal_groups_per_window in params['temporal_groups_per_windows']:
+            layer = MinibatchStddev(params['group_size'], temporal_groups_per_window, params['initial_kernel_size'])
+            timings = time_forward_backward(lambda: layer(x), params['repeats'], params['warmup'])
+            for phase, summary in timings.items():
+                results['MinibatchStddev/temporal_groups={}/depth={}/{}'.format(
+                    temporal_groups_per_window, depth, phase)] = summary
+        layer = cudize(SelfAttention(channels, params['spectral']))
+        timings = time_forward_backward(lambda: layer(x)[0], params['repeats'], params['warmup'], layer.zero_grad)
+        for phase, summary in timings.items():
+            results['SelfAttention/depth={}/{}'.format(depth, phase)] = summary
+        for fused in (False, True):
+            layer = cudize(GeneralConv(channels, channels, act_alpha=0.2, act_norm='pixel',
+                                       do=params['dropout'], fused=fused))
+            timings = time_forward_backward(lambda: layer(x), params['repeats'], params['warmup'], layer.zero_grad)
+            for phase, summary in timings.items():
+                results['GeneralConv/fused={}/depth={}/{}'.format(fused, depth, phase)] = summary
+        print('layers', depth)
+    return results
+
+
+class ThroughputMonitor(Plugin):
+    def __init__(self):
+        super().__init__([(1, 'iteration')])
+        self.phases = {}
+        self.phase = None
+        self.last_time = None
+        self.last_nimg = None
+
+    def register(self, trainer):
+        self.trainer = trainer
+        self.phase = self.current_phase()
+        self.last_nimg = trainer.cur_nimg
+        reset_peak_memory()
+        synchronize()
+        self.last_time = time.perf_counter()
+
+    def current_phase(self):
+        return 'depth={}/{}'.format(self.trainer.generator.depth,
+                                    'stable' if self.trainer.generator.alpha == 1.0 else 'transition')
+
+    def iteration(self, *args):
+        synchronize()
+        now = time.perf_counter()
+        stats = self.phases.setdefault(self.phase, {'seconds': 0.0, 'kimg': 0.0, 'peak_memory_mb': 0.0})
+        stats['seconds'] += now - self.last_time
+        stats['kimg'] += (self.trainer.cur_nimg - self.last_nimg) / 1000.0
+        stats['peak_memory_mb'] = max(stats['peak_memory_mb'], peak_memory_mb())
+        phase = self.current_phase()
+        if phase != self.phase:
+            reset_peak_memory()
+        self.phase = phase
+        self.last_nimg = self.trainer.cur_nimg
+        self.last_time = time.perf_counter()
+
+    def summary(self):
+        return {phase: {**stats, 'kimg_per_sec': stats['kimg'] / stats['seconds'],
+                        'sec_per_kimg': stats['seconds'] / stats['kimg']}
+                for phase, stats in self.phases.items() if stats['kimg'] > 0}
+
+
+def bench_training(params):
+    work_dir = params['training_dir'] or tempfile.mkdtemp(prefix='eeg_gan_benchmark_')
+    corpus_dir = os.path.join(work_dir, 'corpus')
+    if not os.path.exists(corpus_dir):
+        write_corpus(corpus_dir, params['corpus_files'], duration=params['corpus_duration'],
+                     file_format=params['corpus_format'], random_seed=params['random_seed'])
+    phase_kimg = params['training_phase_kimg']
+    train_params = parse_config(deepcopy(train_default_params), need_arg_classes, read_cli=False)
+    train_params.update(result_dir=os.path.join(work_dir, 'results'), exp_name='benchmark',
+                        total_kimg=phase_kimg * (2 * params['training_depths'] + 1))
+    train_params['EEGDataset'].update(dir_path=corpus_dir, validation_ratio=0.0, validation_seed=0)
+    train_params['DepthManager'].update(lod_training_kimg=phase_kimg, lod_transition_kimg=phase_kimg,
+                                        minibatch_default=params['training_minibatch_size'], minibatch_override={},
+                                        tick_kimg_override={}, training_kimg_override={},
+                                        transition_kimg_override={},
+                                        autotune_minibatch=params['training_autotune'])
+    train_params['Trainer']['tick_kimg_default'] = phase_kimg
+    train_params['SaverPlugin']['network_snapshot_ticks'] = 10 ** 6
+    train_params['OutputGenerator']['output_snapshot_ticks'] = 10 ** 6
+    monitor = ThroughputMonitor()
+    start = time.perf_counter()
+    train_main(train_params, [monitor])
+    results = {'training/{}'.format(phase): stats for phase, stats in monitor.summary().items()}
+    for name, stats in results.items():
+        print(name, '{:.3f} kimg/s'.format(stats['kimg_per_sec']), '{:.1f} MB'.format(stats['peak_memory_mb']))
+    print('total training time: {:.1f}s'.format(time.perf_counter() - start))
+    return results
+
+
+def result_time(summary):
+    if 'saved_mb' in summary:  # not a time, but it regresses the same way
+        return summary['saved_mb']
+    return summary['median'] if 'median' in summary else summary['sec_per_kimg']
+
+
+def compare_to_baseline(results, baseline, threshold):
+    regressions = {}
+    for name, summary in results.items():
+        if name not in baseline:
+            continue
+        ratio = result_time(summary) / max(result_time(baseline[name]), 1e-12)
+        if ratio > 1.0 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def main(params):
+    torch.manual_seed(params['random_seed'])
+    np.random.seed(params['random_seed'])
+    suites = {'networks': bench_networks, 'losses': bench_losses, 'layers': bench_layers,
+              'training': bench_training}
+    results = {}
+    for suite in params['suites']:
+        results.update(suites[suite](params))
+    report = {'params': params, 'torch': torch.__version__,
+              'device': torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu', 'results': results}
+    with open(params['output'], 'w') as f:
+        json.dump(report, f, indent=2)
+    if not params['baseline']:
+        return {}
+    with open(params['baseline']) as f:
+        baseline = json.load(f)['results']
+    regressions = compare_to_baseline(results, baseline, params['threshold'])
+    for name, ratio in sorted(regressions.items(), key=lambda item: -item[1]):
+        print('regression: {} is {:.2f}x slower than the baseline'.format(name, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    if main(simple_argparser(default_params)):
+        exit(1)
@@ -0,0 +1,274 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch import nn
+
+from cpc.cpc_network import SincConv, SincEncoder
+from dataset import EEGDataset
+from layers import SelfAttention
+from network import Generator, Discriminator, MultiDiscriminator
+from plugins import DepthManager
+from train import default_params as train_default_params, need_arg_classes, create_networks
+from utils import parse_config
+
+default_params = dict(
+    **train_default_params,
+    multi_discriminator=False,  # analyze a MultiDiscriminator (built from the Discriminator params) instead
+    probe_batch_size=4,  # batch size of the (no_grad) forward pass used to trace the shapes
+    transition_alpha=0.5,
+    device_tflops=0.0,  # sustained throughput of the device, set it to get a rough estimate of the training time
+    output='',  # optional json output
+)
+
+# adam keeps the weight, its gradient and two moments
+TRAINING_BYTES_PER_PARAM_BYTE = 4
+# the gradient penalty runs a forward pass on the interpolated input, a create_graph backward w.r.t. the input and
+# then a backward through both of them, roughly 6 forward passes of the discriminator
+GRADIENT_PENALTY_FORWARDS = 6
+
+
+def block_labels(network, prefix=''):
+    """maps every submodule to the block it belongs to, like 'blocks.3', 'block0' or 'self_attention.1'"""
+    labels = {}
+    self_attention = {m: 'self_attention.{}'.format(l) for l, m in getattr(network, 'self_attention', {}).items()}
+    for name, child in network.named_children():
+        if isinstance(child, (Generator, Discriminator)):  # sub networks of the MultiDiscriminator
+            labels.update(block_labels(child, prefix + name + '.'))
+        elif isinstance(child, nn.ModuleList):
+            for i, block in enumerate(child):
+                label = self_attention.get(block, '{}{}.{}'.format(prefix, name, i))
+                labels.update({m: label for m in block.modules()})
+        else:
+            labels.update({m: prefix + name for m in child.modules()})
+    return labels
+
+
+def module_macs(module, output):
+    if isinstance(module, nn.Conv1d):
+        return output.numel() * module.in_channels // module.groups * module.kernel_size[0]
+    if isinstance(module, SincConv):
+        return output.numel() * module.kernel_size
+    if isinstance(module, SincEncoder):  # a grouped conv of its SincConvs filters when it's not shared
+        return output.numel() * module.sinc[0].kernel_size
+    if isinstance(module, nn.Linear):
+        return output.numel() * module.in_features
+    return 0
+
+
+def attention_cost(module, x):
+    """the quadratic part of SelfAttention: key^T query and value attention (the 1x1 convs are counted separately)"""
+    d_key = module.query_conv.conv.conv.out_channels
+    d_value = module.value_conv.conv.conv.out_channels
+    batch_size, _, seq_len = x.size()
+    num_keys = module.pooling(x[:1, :1]).size(2)
+    macs = batch_size * num_keys * seq_len * (d_key + d_value)
+    # the scores and their softmax of one query chunk at a time (the whole matrix when it's returned)
+    num_queries = seq_len if module.return_attention or not module.query_chunk_size else \
+        min(seq_len, module.query_chunk_size)
+    return macs, 2 * batch_size * num_keys * num_queries * x.element_size()
+
+
+def network_input(network, batch_size, num_channels, seq_len, num_classes):
+    y = torch.zeros(batch_size, num_classes) if num_classes else None
+    if isinstance(network, Generator):
+        if network.conv_only:
+            return torch.randn(batch_size, network.input_latent_size, network.initial_kernel_size), y
+        return torch.randn(batch_size, network.input_latent_size), y
+    return torch.randn(batch_size, num_channels, seq_len), y
+
+
+def network_cost(network, depth, alpha, inputs):
+    """
+    traces a no_grad forward pass of the network and returns the per sample MACs and activation bytes and the
+    parameter bytes of every block that takes part in the given depth and alpha
+    """
+    network.depth = depth
+    network.alpha = alpha
+    labels = block_labels(network)
+    blocks = OrderedDict()
+    seen_params = set()
+    batch_size = inputs[0].size(0)
+
+    def block(module):
+        label = labels.get(module, 'root')
+        if label not in blocks:
+            blocks[label] = dict(macs=0, activation_bytes=0, param_bytes=0, attention_macs=0)
+        return blocks[label]
+
+    def hook(module, _inputs, output):
+        cost = block(module)
+        for p in module.parameters(recurse=False):
+            if id(p) not in seen_params:
+                seen_params.add(id(p))
+                cost['param_bytes'] += p.numel() * p.element_size()
+        if isinstance(module, SelfAttention):
+            macs, activation_bytes = attention_cost(module, _inputs[0])
+            cost['macs'] += macs / batch_size
+            cost['attention_macs'] += macs / batch_size
+            cost['activation_bytes'] += activation_bytes / batch_size
+        elif (len(list(module.children())) == 0 or isinstance(module, SincEncoder) and not module.is_shared) and \
+                torch.is_tensor(output):
+            cost['macs'] += module_macs(module, output) / batch_size
+            cost['activation_bytes'] += output.numel() * output.element_size() / batch_size
+
+    handles = [m.register_forward_hook(hook) for m in network.modules()
+               if not isinstance(m, (Generator, Discriminator, MultiDiscriminator))]
+    try:
+        with torch.no_grad():
+            network(*inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return dict(blocks=blocks, macs=sum(b['macs'] for b in blocks.values()),
+                attention_macs=sum(b['attention_macs'] for b in blocks.values()),
+                activation_bytes=sum(b['activation_bytes'] for b in blocks.values()),
+                active_param_bytes=sum(b['param_bytes'] for b in blocks.values()),
+                param_bytes=sum(p.numel() * p.element_size() for p in network.parameters()))
+
+
+def training_cost(g_cost, d_cost, minibatch_size, d_training_repeats, gradient_penalty=True):
+    """
+    estimates the cost of one kimg of training (as counted by the Trainer: every discriminator step consumes a
+    minibatch of real images) and the device memory of one iteration
+    """
+    f_g, f_d = g_cost['macs'], d_cost['macs']
+    # G forward (no_grad), D forward on reals and fakes and its backward (~2x forward)
+    d_step = f_g + 6 * f_d
+    if gradient_penalty:
+        d_step += GRADIENT_PENALTY_FORWARDS * f_d
+    # G and D forward and the backward through both of them
+    g_step = 3 * (f_g + f_d)
+    macs_per_img = (d_training_repeats * d_step + g_step) / d_training_repeats
+    # saved activations: reals and fakes (+ interpolated input and its gradient graph) or the G step graph
+    d_activations = (4 if gradient_penalty else 2) * d_cost['activation_bytes']
+    g_activations = g_cost['activation_bytes'] + d_cost['activation_bytes']
+    activation_bytes = minibatch_size * max(d_activations, g_activations)
+    param_bytes = TRAINING_BYTES_PER_PARAM_BYTE * (g_cost['param_bytes'] + d_cost['param_bytes'])
+    return dict(minibatch_size=minibatch_size, macs_per_kimg=macs_per_img * 1000, activation_bytes=activation_bytes,
+                param_bytes=param_bytes, total_bytes=activation_bytes + param_bytes)
+
+
+def schedule(params, max_depth):
+    """yields (depth, alpha, kimg) for every phase of the training, alpha is None for the transitions"""
+    dm = params['DepthManager']
+    training_override = dm['training_kimg_override']
+    transition_override = dm['transition_kimg_override']
+    points = DepthManager.pre_compute_alpha_map(
+        dm['depth_offset'], max_depth, dm['lod_training_kimg'],
+        DepthManager.training_kimg_override if training_override is None else training_override,
+        dm['lod_transition_kimg'],
+        DepthManager.transition_kimg_override if transition_override is None else transition_override)
+    total_nimg = params['total_kimg'] * 1000
+    if dm['disable_progression']:
+        yield max_depth, 1.0, params['total_kimg']
+        return
+    start = 0
+    depth = dm['depth_offset']
+    for i, end in enumerate(points + [total_nimg]):
+        end = min(end, total_nimg)
+        if end > start:
+            yield depth, (1.0 if i % 2 == 0 else None), (end - start) / 1000.0
+        start = max(start, end)
+        if i % 2 == 0:
+            depth += 1
+
+
+def minibatch_size(params, depth):
+    dm = params['DepthManager']
+    depth -= dm['depth_offset']
+    if dm['autotune_minibatch'] and dm['autotuned_minibatch'] and depth in dm['autotuned_minibatch']:
+        return dm['autotuned_minibatch'][depth]
+    override = DepthManager.minibatch_override if dm['minibatch_override'] is None else dm['minibatch_override']
+    return override.get(depth, dm['minibatch_default'])
+
+
+def dataset_geometry(dataset_params):
+    picked_channels = dataset_params.get('picked_channels', EEGDataset.picked_channels)
+    num_channels = dataset_params['num_channels'] if picked_channels is None else len(picked_channels)
+    return (dataset_params['start_seq_len'], num_channels,
+            dataset_params.get('progression_scale_up', EEGDataset.progression_scale_up),
+            dataset_params.get('progression_scale_down', EEGDataset.progression_scale_down))
+
+
+def create_discriminator(params, initial_kernel_size, num_channels, progression_scale_up, progression_scale_down):
+    generator, discriminator = create_networks(params, initial_kernel_size, num_channels, progression_scale_up,
+                                               progression_scale_down)
+    if not params['multi_discriminator']:
+        return generator, discriminator
+    shared = dict(initial_kernel_size=initial_kernel_size, num_rgb_channels=num_channels,
+                  fmap_base=params['fmap_base'], fmap_max=params['fmap_max'], fmap_min=params['fmap_min'],
+                  kernel_size=params['kernel_size'], self_attention_layers=params['self_attention_layers'],
+                  progression_scale_up=progression_scale_up, progression_scale_down=progression_scale_down,
+                  residual=params['residual'], separable=params['separable'], equalized=params['equalized'],
+                  init=params['init'], act_alpha=params['act_alpha'], num_classes=params['num_classes'],
+                  deep=params['deep'])
+    d_params = {k: v for k, v in params['Discriminator'].items() if k != 'sinc'}
+    return generator, MultiDiscriminator(**shared, **d_params)
+
+
+def analyze(params):
+    initial_kernel_size, num_channels, scale_up, scale_down = dataset_geometry(params['EEGDataset'])
+    generator, discriminator = create_discriminator(params, initial_kernel_size, num_channels, scale_up, scale_down)
+    generator.eval()
+    discriminator.eval()
+    seq_lens = initial_kernel_size * np.cumprod([1.0] + [u / d for u, d in zip(scale_up, scale_down)])
+    batch_size = params['probe_batch_size']
+    gradient_penalty = params['grad_lambda'] != 0 and params['loss_type'] in {'wgan_gp', 'wgan_theirs'}
+    phases = []
+    for depth, alpha, kimg in schedule(params, generator.max_depth):
+        is_transition = alpha is None
+        alpha = params['transition_alpha'] if is_transition else alpha
+        g_cost = network_cost(generator, depth, alpha, network_input(
+            generator, batch_size, num_channels, int(seq_lens[depth]), params['num_classes']))
+        d_cost = network_cost(discriminator, depth, alpha, network_input(
+            discriminator, batch_size, num_channels, int(seq_lens[depth]), params['num_classes']))
+        train_cost = training_cost(g_cost, d_cost, minibatch_size(params, depth),
+                                   params['Trainer']['d_training_repeats'], gradient_penalty)
+        phases.append(dict(depth=depth, alpha=alpha, transition=is_transition, kimg=kimg, seq_len=int(seq_lens[depth]),
+                           generator=g_cost, discriminator=d_cost, training=train_cost))
+    return phases
+
+
+def report(phases, device_tflops=0.0):
+    total_macs = 0.0
+    for phase in phases:
+        print('depth {} ({}), seq_len {}, {:.1f} kimg'.format(
+            phase['depth'], 'transition' if phase['transition'] else 'stable', phase['seq_len'], phase['kimg']))
+        for name in ('generator', 'discriminator'):
+            cost = phase[name]
+            print('  {}: {:.2f} MMACs/sample ({:.2f} in self attention), {:.2f} MB activations/sample, '
+                  '{:.2f} MB active parameters'.format(name, cost['macs'] / 1e6, cost['attention_macs'] / 1e6,
+                                                       cost['activation_bytes'] / 2 ** 20,
+                                                       cost['active_param_bytes'] / 2 ** 20))
+            for label, block in cost['blocks'].items():
+                print('    {:<32} {:10.3f} MMACs {:10.3f} MB act {:8.3f} MB params'.format(
+                    label, block['macs'] / 1e6, block['activation_bytes'] / 2 ** 20, block['param_bytes'] / 2 ** 20))
+        train_cost = phase['training']
+        phase_macs = train_cost['macs_per_kimg'] * phase['kimg']
+        total_macs += phase_macs
+        print('  training: minibatch {}, {:.2f} TMACs/kimg, {:.1f} MB memory ({:.1f} activations + {:.1f} '
+              'parameters and optimizer)'.format(train_cost['minibatch_size'], train_cost['macs_per_kimg'] / 1e12,
+                                                 train_cost['total_bytes'] / 2 ** 20,
+                                                 train_cost['activation_bytes'] / 2 ** 20,
+                                                 train_cost['param_bytes'] / 2 ** 20))
+    print('whole run: {:.1f} TMACs, peak memory {:.1f} MB'.format(
+        total_macs / 1e12, max(p['training']['total_bytes'] for p in phases) / 2 ** 20))
+    if device_tflops > 0:
+        # one MAC is two floating point operations
+        print('estimated training time: {:.1f} hours at {} TFLOPS'.format(
+            2 * total_macs / (device_tflops * 1e12) / 3600, device_tflops))
+
+
+def main(params):
+    phases = analyze(params)
+    report(phases, params['device_tflops'])
+    if params['output']:
+        with open(params['output'], 'w') as f:
+            json.dump(phases, f, indent=2)
+    return phases
+
+
+if __name__ == '__main__':
+    main(parse_config(default_params, need_arg_classes))
@@ -23,7 +23,9 @@ class SincEncoder(nn.Module):
         B, C, T = x.shape
         if self.is_shared:
             return self.sinc(x.view(B * C, 1, T)).view(B, -1, T)
-        return torch.cat([self.sinc[i](x[:, i:i + 1, :]) for i in range(C)], dim=1)
+        # every channel with its own filter bank, as a single grouped conv
+        filters = torch.cat([sinc.filter_bank(x) for sinc in self.sinc], dim=0)
+        return self.sinc[0].apply_filters(x, filters, groups=C)
 
 
 class SincConv(nn.Module):
@@ -44,13 +46,13 @@ class SincConv(nn.Module):
         self.band_hz_ = nn.Parameter(torch.Tensor(np.diff(hz)).view(-1, 1))
         # Hamming window
         n_lin = torch.linspace(0, (self.kernel_size / 2) - 1, steps=int((self.kernel_size / 2)))
-        self.window_ = 0.54 - 0.46 * torch.cos(2.0 * math.pi * n_lin / self.kernel_size)
+        self.register_buffer('window_', 0.54 - 0.46 * torch.cos(2.0 * math.pi * n_lin / self.kernel_size),
+                             persistent=False)
         n = (self.kernel_size - 1) / 2.0
-        self.n_ = 2 * math.pi * torch.arange(-n, 0).view(1, -1) / self.sample_rate
+        self.register_buffer('n_', 2 * math.pi * torch.arange(-n, 0).view(1, -1) / self.sample_rate, persistent=False)
+        self._cache = None
 
-    def forward(self, waveforms):
-        self.n_ = self.n_.to(waveforms.device)
-        self.window_ = self.window_.to(waveforms.device)
+    def make_filters(self):
         low = self.min_low_hz + torch.abs(self.low_hz_)
         high = torch.clamp(low + self.min_band_hz + torch.abs(self.band_hz_), self.min_low_hz, self.sample_rate / 2)
         band = (high - low)[:, 0]
@@ -61,9 +63,28 @@ class SincConv(nn.Module):
         band_pass_right = torch.flip(band_pass_left, dims=[1])
         band_pass = torch.cat([band_pass_left, band_pass_center, band_pass_right], dim=1)
         band_pass = band_pass / (2 * band[:, None])
-        self.filters = band_pass.view(self.out_channels, 1, self.kernel_size)
+        return band_pass.view(self.out_channels, 1, self.kernel_size)
+
+    def filter_bank(self, x):
+        """
+        the filters, reused until low_hz_ or band_hz_ change (their version counters move on every in place update)
+        unless they have to be part of the graph
+        """
+        if torch.is_grad_enabled() and (self.low_hz_.requires_grad or self.band_hz_.requires_grad):
+            self._cache = None
+            return self.make_filters().to(x.dtype)
+        key = (self.low_hz_._version, self.band_hz_._version, self.low_hz_.data_ptr(), self.band_hz_.data_ptr(),
+               x.dtype)
+        if self._cache is None or self._cache[0] != key:
+            self._cache = (key, self.make_filters().to(x.dtype))
+        return self._cache[1]
+
+    def apply_filters(self, waveforms, filters, groups=1):
         x_p = F.pad(waveforms, (self.kernel_size // 2, self.kernel_size // 2), mode='reflect')
-        return F.conv1d(x_p, self.filters, bias=None)
+        return F.conv1d(x_p, filters, bias=None, groups=groups)
+
+    def forward(self, waveforms):
+        return self.apply_filters(waveforms, self.filter_bank(waveforms))
 
 
 class ResidualEncoder(nn.Sequential):
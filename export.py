@@ -0,0 +1,488 @@
+import os
+import json
+import time
+import warnings
+import tempfile
+from copy import deepcopy
+
+import yaml
+import torch
+from torch import nn
+from torch.ao.quantization import (QConfig, HistogramObserver, QuantStub, DeQuantStub, prepare, convert,
+                                   default_per_channel_weight_observer)
+
+from layers import (GeneralConv, EqualizedConv1d, EqualizedSeparableConv1d, GDropLayer, ScaledConv1d,
+                    ConditionalBatchNorm)
+from network import Generator
+from utils import simple_argparser, load_model
+
+default_params = dict(
+    checkpoint='',  # results/001-test/network-snapshot-smooth_generator-000025.dat
+    config_file='',  # empty means the conf.yml next to the checkpoint
+    output='generator.pt',
+    batch_size=4,  # of the example input, the exported graph works for any batch size
+    latent_steps=0,  # the latent length of a conv_only generator's graph, 0 means initial_kernel_size
+    cuda=False,
+    quantize=False,  # int8 convs for cpu inference (see quantize_generator), also writes a report next to output
+    float_layers=['generator.block0'],  # names (prefixes) of the layers of the frozen generator that stay float
+    calibration_batches=32,  # latent batches that set the activation ranges of the int8 convs
+    calibration_batch_size=64,
+    report_samples=256,  # per batch of the fidelity and throughput report
+    bn_calibration_batches=64,  # latent batches that the batch norm statistics are recomputed on, 0 keeps them
+    bn_calibration_batch_size=64,
+    random_seed=0,  # of the calibration and report latents
+)
+
+
+def networks_from_config(config_file, legacy=False):
+    """
+    the (untrained) Generator and Discriminator of a training run, rebuilt from its conf.yml, with legacy=True they
+    get the equalized scales of the training (seeded like train.py), for checkpoints from before the scales were saved
+    """
+    from train import create_networks
+
+    with open(config_file) as f:
+        params = yaml.load(f, Loader=yaml.Loader)
+    dataset_params = params['EEGDataset']
+    picked_channels = dataset_params['picked_channels']
+    num_channels = dataset_params['num_channels'] if picked_channels is None else len(picked_channels)
+    if legacy:
+        torch.manual_seed(params['random_seed'])
+    return create_networks(params, dataset_params['start_seq_len'], num_channels,
+                           dataset_params['progression_scale_up'], dataset_params['progression_scale_down'])
+
+
+def config_next_to(checkpoint, config_file=''):
+    return config_file or os.path.join(os.path.dirname(checkpoint), 'conf.yml')
+
+
+def load_network(checkpoint, config_file, index):
+    """the network (index 0 for the Generator, 1 for the Discriminator) of a training run with its checkpoint loaded"""
+    state = load_model(checkpoint)
+    legacy = not any(key.endswith('conv.scale') for key in state)
+    if legacy:
+        print('warning: {} has no equalized scales, they are rebuilt from the seed of the training'.format(checkpoint))
+    network = networks_from_config(config_next_to(checkpoint, config_file), legacy)[index]
+    network.load_state_dict(state)
+    return network
+
+
+def load_generator(checkpoint, config_file=''):
+    """rebuilds the Generator of a training run from its conf.yml and loads the checkpoint into it"""
+    return load_network(checkpoint, config_file, 0)
+
+
+def load_discriminator(checkpoint, config_file=''):
+    """the Discriminator of a checkpoint in eval mode at max_depth with alpha=1 and without gdrop (for scoring)"""
+    discriminator = load_network(checkpoint, config_file, 1)
+    discriminator.depth = discriminator.max_depth
+    discriminator.alpha = 1.0
+    for m in discriminator.modules():
+        if isinstance(m, GDropLayer):
+            m.strength = 0
+    return discriminator.eval()
+
+
+def fold_conv(layer):
+    """replaces the ScaledConv1d of an EqualizedConv1d (and its spectral norm) with an unscaled one, same weight"""
+    with torch.no_grad():
+        weight = layer.conv.effective_weight().detach().clone()
+        conv = layer.conv
+        plain = ScaledConv1d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                          conv.dilation, conv.groups, True).to(weight)
+        plain.weight.copy_(weight)
+        if conv.bias is None:
+            plain.bias.zero_()
+        else:
+            plain.bias.copy_(conv.bias)
+    layer.conv = plain
+
+
+def last_conv(layer):
+    """the conv of a GeneralConv whose output goes into its norm"""
+    if isinstance(layer.conv, EqualizedSeparableConv1d):
+        return layer.conv.net[-1].conv
+    return layer.conv.conv
+
+
+def fold_batch_norm(layer):
+    """folds the (running) statistics of the batch norm of a GeneralConv into its conv, the embedding part stays"""
+    normalizer = layer.norm.normalizer
+    conv = last_conv(layer)
+    with torch.no_grad():
+        scale = torch.rsqrt(normalizer.running_var + normalizer.eps)
+        shift = -normalizer.running_mean * scale
+        if normalizer.affine:
+            scale, shift = scale * normalizer.weight, shift * normalizer.weight + normalizer.bias
+        conv.weight.mul_(scale[:, None, None])
+        conv.bias.mul_(scale).add_(shift)
+    layer.norm.normalizer = nn.Identity()
+
+
+def drop_gdrop(layer):
+    layer.net = nn.Sequential(*[m for m in layer.net if not isinstance(m, GDropLayer)])
+    layer.drop = None
+
+
+class InferenceGenerator(nn.Module):
+    """the output signal of the generator at its current depth and alpha, as a tensor (so it can be traced)"""
+
+    def __init__(self, generator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, z, y=None):
+        return self.generator(z, y)[0]['x']
+
+
+def freeze_generator(generator):
+    """
+    an eval mode copy of the generator at max_depth with alpha=1, without gdrop and with plain conv weights (the
+    equalized scales and the spectral norms folded in) and the batch norms folded into the convs before them, unless
+    there is a per channel noise in between
+    """
+    generator = deepcopy(generator).eval()
+    generator.depth = generator.max_depth
+    generator.alpha = 1.0
+    for m in list(generator.modules()):
+        if isinstance(m, EqualizedConv1d):
+            fold_conv(m)
+        if isinstance(m, GeneralConv):
+            drop_gdrop(m)
+    for block in [generator.block0] + list(generator.blocks):
+        if block.noises is None:
+            for layer in block.convs:
+                if layer.norm is not None:
+                    fold_batch_norm(layer)
+    for p in generator.parameters():
+        p.requires_grad_(False)
+    return InferenceGenerator(generator).eval()
+
+
+def example_inputs(generator, batch_size, latent_steps=0):
+    g = generator.generator
+    like = next(g.parameters())
+    z = torch.randn(batch_size, g.input_latent_size, *([latent_steps or g.initial_kernel_size] if g.conv_only else []))
+    z = z.to(like)
+    return (z,) if g.num_classes == 0 else (z, torch.randn(batch_size, g.num_classes).to(like))
+
+
+def quantizable_convs(model, float_layers=()):
+    """
+    the EqualizedConv1d layers of a frozen generator that quantize_generator replaces, which leaves out the (tiny)
+    embeddings of the conditional batch norms, whose weights batched_linear reads directly
+    """
+    embeddings = {id(m) for norm in model.modules() if isinstance(norm, ConditionalBatchNorm) for m in norm.modules()}
+    return [(name, m) for name, m in model.named_modules() if isinstance(m, EqualizedConv1d)
+            and id(m) not in embeddings and not any(name.startswith(prefix) for prefix in float_layers)]
+
+
+def quantize_generator(generator, calibration_inputs, float_layers=(), backend='x86'):
+    """
+    the frozen generator with static int8 convs (per channel weights, activations quantized right before each conv and
+    dequantized after it, so the rest stays float), calibration_inputs are the input tuples that the activation ranges
+    are observed on. dynamic quantization has no convs, hence the calibration. the weights are packed for backend, the
+    quantized engine that the model should run with (the global engine is set to it only while quantizing)
+    """
+    engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        model = freeze_generator(generator).cpu().float()
+        qconfig = QConfig(activation=HistogramObserver.with_args(reduce_range=False),
+                          weight=default_per_channel_weight_observer)
+        originals = {}
+        for _, layer in quantizable_convs(model, float_layers):
+            conv = originals[layer] = layer.conv
+            plain = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                              conv.dilation, conv.groups, True)
+            plain.load_state_dict({'weight': conv.weight, 'bias': conv.bias})
+            layer.conv = nn.Sequential(QuantStub(), plain, DeQuantStub())
+            layer.conv.qconfig = qconfig
+        prepare(model, inplace=True)
+        with torch.no_grad():
+            for inputs in calibration_inputs:
+                model(*inputs)
+        for layer, conv in originals.items():
+            if torch.isinf(layer.conv[0].activation_post_process.min_val):  # not used at max_depth (older to_rgbs)
+                layer.conv = conv
+        return convert(model, inplace=True).eval()
+    finally:
+        torch.backends.quantized.engine = engine
+
+
+def latent_batches(generator, num_batches, batch_size, seed, latent_steps=0):
+    """input tuples of a frozen generator, drawn like generate.py draws them"""
+    from generate import sample_latents
+
+    config = export_config(generator)
+    config['initial_kernel_size'] = latent_steps or config['initial_kernel_size']  # the z length of sample_latents
+    rng = torch.Generator().manual_seed(seed)
+    for _ in range(num_batches):
+        z, labels = sample_latents(config, batch_size, rng)
+        yield (z,) if labels is None else (z, nn.functional.one_hot(labels, config['num_classes']).float())
+
+
+def batch_norms(generator):
+    return [m for m in generator.modules() if isinstance(m, nn.BatchNorm1d)]
+
+
+def calibrate_batch_norms(generator, num_batches, batch_size=64, seed=0, latent_steps=0):
+    """
+    a copy of the generator whose batch norms have the average statistics of num_batches latent batches at max_depth
+    with alpha=1 and without gdrop, like it's exported, instead of the running averages of the training, which drift
+    along the progressive growing and were never those of the final network only, so small batches (which can't use
+    their own statistics) generate like the big ones of the training
+    """
+    generator = deepcopy(generator).eval()
+    generator.depth = generator.max_depth
+    generator.alpha = 1.0
+    for m in generator.modules():
+        if isinstance(m, GDropLayer):
+            m.strength = 0
+    norms = batch_norms(generator)
+    momenta = [m.momentum for m in norms]
+    for m in norms:
+        m.reset_running_stats()
+        m.momentum = None  # a cumulative average
+        m.train()
+    like = next(generator.parameters())
+    with torch.no_grad():
+        for inputs in latent_batches(generator, num_batches, batch_size, seed, latent_steps):
+            generator(*[x.to(like) for x in inputs])
+    for m, momentum in zip(norms, momenta):
+        m.momentum = momentum
+    return generator.eval()
+
+
+def trace_generator(model, inputs):
+    with torch.no_grad(), warnings.catch_warnings():
+        # the signal lengths (and so the resampling kernels) are constants of the graph on purpose, only the batch
+        # size is dynamic
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(model, inputs, check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def export_generator(generator, batch_size=4, device='cpu', latent_steps=0):
+    """the frozen generator traced into a TorchScript module"""
+    model = freeze_generator(generator).to(device)
+    return trace_generator(model, example_inputs(model, batch_size, latent_steps))
+
+
+def log_spectrum(x):
+    """log10 of the power spectral density of each channel, averaged over the batch"""
+    return torch.log10((torch.fft.rfft(x.double(), dim=2).abs() ** 2).mean(dim=0) + 1e-12)
+
+
+def swd_descriptors(x, patch_size, mean=None, std=None):
+    """non overlapping (all channels x patch_size) patches, normalized per channel like the swd plugin"""
+    patches = x.unfold(2, min(patch_size, x.size(2)), min(patch_size, x.size(2))).permute(0, 2, 1, 3)
+    patches = patches.reshape(-1, x.size(1), patches.size(3))
+    if mean is None:
+        mean, std = patches.mean(dim=(0, 2), keepdim=True), patches.std(dim=(0, 2), keepdim=True) + 1e-8
+    return ((patches - mean) / std).reshape(patches.size(0), -1), mean, std
+
+
+def samples_per_second(model, inputs, repeats=3):
+    with torch.no_grad():
+        model(*inputs)  # warm up (and let the TorchScript profiler settle)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(*inputs)
+    return repeats * inputs[0].size(0) / (time.perf_counter() - start)
+
+
+def quantization_report(float_model, quantized_model, inputs, reference_inputs, patch_size=16):
+    """
+    how far the int8 samples are from the float ones of the same latents: relative and max errors, the mean absolute
+    difference of their log spectra (in decibels), the deltas of the statistics and of the sliced wasserstein distance
+    to float samples of other latents (reference_inputs), and both throughputs
+    """
+    from metrics.laplacian_swd import sliced_wasserstein_torch
+
+    with torch.no_grad():
+        x, q, reference = float_model(*inputs), quantized_model(*inputs), float_model(*reference_inputs)
+    reference, mean, std = swd_descriptors(reference, patch_size)
+    swd_float = sliced_wasserstein_torch(reference, swd_descriptors(x, patch_size, mean, std)[0], 4, 128)
+    swd_int8 = sliced_wasserstein_torch(reference, swd_descriptors(q, patch_size, mean, std)[0], 4, 128)
+    return dict(relative_error=((q - x).norm() / x.norm()).item(), max_error=(q - x).abs().max().item(),
+                spectral_error_db=10 * (log_spectrum(q) - log_spectrum(x)).abs().mean().item(),
+                mean_delta=(q.mean() - x.mean()).item(), std_delta=(q.std() - x.std()).item(),
+                swd_float=swd_float, swd_delta=swd_int8 - swd_float,
+                float_samples_per_second=samples_per_second(float_model, inputs),
+                int8_samples_per_second=samples_per_second(quantized_model, inputs))
+
+
+def export_config(generator, latent_steps=0, quantized=False):
+    """what the users of an exported generator need to know, saved next to it in the TorchScript archive"""
+    g = generator.generator if isinstance(generator, InferenceGenerator) else generator
+    config = dict(latent_size=g.input_latent_size, z_distribution=g.z_distribution, conv_only=g.conv_only,
+                  initial_kernel_size=g.initial_kernel_size, num_classes=g.num_classes, quantized=quantized)
+    if g.conv_only:  # see generate.stream_chunks
+        receptive_field = g.receptive_field(g.max_depth)
+        config.update(latent_steps=latent_steps or g.initial_kernel_size,
+                      receptive_field=None if receptive_field is None else receptive_field[0],
+                      output_ratio=None if receptive_field is None else receptive_field[1])
+    return config
+
+
+def save_exported(traced, config, path):
+    torch.jit.save(traced, path, _extra_files={'config.json': json.dumps(config)})
+
+
+def load_exported(path, map_location='cpu'):
+    """returns the TorchScript generator and its export_config"""
+    extra_files = {'config.json': ''}
+    traced = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return traced, json.loads(extra_files['config.json'])
+
+
+def test_export():
+    from utils import set_noise_seed
+
+    shared = dict(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16)
+    for settings in [dict(self_attention_layers=[1], separable=False, equalized=True, spectral=False,
+                          act_norm='pixel', num_classes=0),
+                     dict(self_attention_layers=[], separable=True, equalized=True, spectral=True, act_norm='batch',
+                          num_classes=0),
+                     dict(self_attention_layers=[], separable=False, equalized=False, spectral=True,
+                          act_norm='batch', num_classes=3, z_to_bn=True)]:
+        g = Generator(**shared, **settings).double()
+        set_noise_seed(0)
+        with torch.no_grad():
+            g.depth = g.max_depth
+            for _ in range(3):  # some batch norm statistics and power iterations
+                g(torch.randn(16, 16, dtype=torch.float64), torch.randn(16, 3, dtype=torch.float64))
+        traced = export_generator(g)
+        reference = deepcopy(g).eval()
+        reference.depth = reference.max_depth
+        for m in reference.modules():
+            if isinstance(m, GDropLayer):
+                m.strength = 0
+        for batch_size in [1, 5]:
+            z = torch.randn(batch_size, 16, dtype=torch.float64)
+            y = torch.randn(batch_size, 3, dtype=torch.float64)
+            inputs = (z, y) if settings['num_classes'] else (z,)
+            with torch.no_grad():
+                expected = reference(*inputs)[0]['x']
+                assert torch.allclose(traced(*inputs), expected, atol=1e-10), settings
+        with tempfile.TemporaryDirectory() as directory:
+            save_exported(traced, export_config(g), os.path.join(directory, 'generator.pt'))
+            loaded, config = load_exported(os.path.join(directory, 'generator.pt'))
+        assert config['num_classes'] == settings['num_classes'] and config['latent_size'] == 16
+        with torch.no_grad():
+            assert torch.equal(loaded(*inputs), traced(*inputs))
+    # the equalized scales come with the state dict, whatever the initialization of the network it's loaded into
+    other = Generator(**shared, **settings).double()
+    other.load_state_dict(g.state_dict())
+    with torch.no_grad():
+        assert torch.allclose(export_generator(other)(*inputs), traced(*inputs), atol=1e-10)
+    g = Generator(**shared, self_attention_layers=[], separable=False, equalized=True, per_channel_noise=True,
+                  num_classes=0)
+    for p in g.parameters():  # the noise weights start at zero
+        nn.init.normal_(p)
+    traced = export_generator(g)
+    z = torch.randn(2, 16)
+    with torch.no_grad():
+        assert not torch.equal(traced(z), traced(z))  # the per channel noise is drawn in every call
+
+
+def test_quantize():
+    from torch.ao.nn.quantized import Conv1d as QuantizedConv1d
+
+    torch.manual_seed(0)
+    g = Generator(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16,
+                  self_attention_layers=[], separable=False, equalized=True, spectral=True, act_norm='batch',
+                  num_classes=3, z_to_bn=True)
+    g.depth = g.max_depth
+    with torch.no_grad():
+        for _ in range(3):
+            g(torch.randn(16, 16), torch.randn(16, 3))
+    model = freeze_generator(g)
+    calibration = list(latent_batches(model, 4, 32, 0))
+    inputs, reference_inputs = latent_batches(model, 2, 64, 1)
+    engine = torch.backends.quantized.engine
+    quantized = quantize_generator(g, calibration, backend='qnnpack' if engine == 'x86' else 'x86')
+    assert torch.backends.quantized.engine == engine
+    quantized = quantize_generator(g, calibration)
+    num_quantized = sum(isinstance(m, QuantizedConv1d) for m in quantized.modules())
+    assert 0 < num_quantized == len(quantizable_convs(model)) - g.max_depth  # the older to_rgbs stay float
+    report = quantization_report(model, quantized, inputs, reference_inputs)
+    # a few percent and a fraction of a decibel here, a broken calibration (or folding) is at tens of percent
+    assert report['relative_error'] < 0.06 and report['spectral_error_db'] < 1, report
+    assert abs(report['swd_delta']) < 0.05 and abs(report['std_delta']) < 0.01, report
+    with torch.no_grad():  # nothing to quantize, the same as the float generator
+        assert torch.equal(quantize_generator(g, calibration, ['generator'])(*inputs), model(*inputs))
+        traced = trace_generator(quantized, inputs)
+        with tempfile.TemporaryDirectory() as directory:
+            save_exported(traced, export_config(g, quantized=True), os.path.join(directory, 'generator.pt'))
+            loaded, config = load_exported(os.path.join(directory, 'generator.pt'))
+        assert config['quantized'] and torch.allclose(loaded(*reference_inputs), quantized(*reference_inputs))
+
+
+def test_calibrate_batch_norms():
+    g = Generator(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16,
+                  self_attention_layers=[], separable=False, equalized=True, spectral=False, act_norm='batch',
+                  num_classes=3, z_to_bn=True).double()
+    with torch.no_grad():  # the statistics of the last blocks are never updated and those of the first ones drift
+        for depth in range(g.max_depth):
+            g.depth = depth
+            g(torch.randn(16, 16, dtype=torch.float64), torch.randn(16, 3, dtype=torch.float64))
+    calibrated = calibrate_batch_norms(g, 16, 64)
+    assert all(m.momentum == 0.1 and not m.training for m in batch_norms(calibrated))
+    assert g.depth == g.max_depth - 1  # a copy
+    # the statistics of a single big batch, which a batch of one at inference should match
+    reference = deepcopy(calibrated)
+    for m in batch_norms(reference):
+        m.train()
+    inputs = next(latent_batches(freeze_generator(g), 1, 2048, 1))
+    inputs = [x.double() for x in inputs]
+    with torch.no_grad():
+        expected = reference(*inputs)[0]['x']
+        errors = [((freeze_generator(model)(*inputs) - expected).norm() / expected.norm()).item()
+                  for model in [g, calibrated]]
+        assert errors[1] < errors[0] / 5, errors
+        single = torch.cat([freeze_generator(calibrated)(*[x[i:i + 1] for x in inputs]) for i in range(4)])
+        assert torch.allclose(single, freeze_generator(calibrated)(*inputs)[:4])
+
+
+def main(params):
+    generator = load_generator(params['checkpoint'], params['config_file'])
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    if params['bn_calibration_batches'] and batch_norms(generator):
+        generator = calibrate_batch_norms(generator, params['bn_calibration_batches'],
+                                          params['bn_calibration_batch_size'], params['random_seed'] + 2,
+                                          params['latent_steps'])
+    if params['quantize']:  # on the cpu
+        model = freeze_generator(generator).float()
+
+        def batches(num_batches, batch_size, seed):
+            return list(latent_batches(model, num_batches, batch_size, seed, params['latent_steps']))
+
+        quantized = quantize_generator(generator, batches(params['calibration_batches'],
+                                                          params['calibration_batch_size'], params['random_seed']),
+                                       params['float_layers'])
+        inputs = example_inputs(model, params['batch_size'], params['latent_steps'])
+        traced = trace_generator(quantized, inputs)
+        report = quantization_report(trace_generator(model, inputs), traced,
+                                     *batches(2, params['report_samples'], params['random_seed'] + 1))
+        report_file = os.path.splitext(params['output'])[0] + '-int8.json'
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
+    else:
+        traced = export_generator(generator, params['batch_size'], device, params['latent_steps'])
+    config = export_config(generator, params['latent_steps'], params['quantize'])
+    config['bn_calibration_batches'] = params['bn_calibration_batches'] if batch_norms(generator) else 0
+    save_exported(traced, config, params['output'])
+    print('exported the generator at depth {} to {}'.format(generator.max_depth, params['output']))
+
+
+if __name__ == '__main__':
+    main(simple_argparser(default_params))
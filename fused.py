@@ -0,0 +1,184 @@
+import warnings
+
+import torch
+from torch.autograd import Function
+
+from utils import EPSILON, device_randn
+
+_compiled = {}
+compile_enabled = hasattr(torch, 'compile')
+
+
+def activation_chain(c, act_alpha, pixel, drop_noise):
+    """leaky relu(act_alpha, linear if it's negative) -> pixel norm -> gdrop multiply, the same as GeneralConv.net"""
+    a = c if act_alpha < 0 else torch.where(c > 0, c, c * act_alpha)
+    if pixel:
+        a = a * torch.rsqrt(torch.mean(a * a, dim=1, keepdim=True) + EPSILON)
+    if drop_noise is not None:
+        a = a * drop_noise
+    return a
+
+
+def gdrop_noise(shape, strength, seed, like):
+    """the multiplicative noise of GDropLayer, the seed is all it takes to draw it again"""
+    return (1 + strength) ** device_randn(shape, like, seed)
+
+
+def activation_forward(c, act_alpha, pixel, drop_noise):
+    a = c if act_alpha < 0 else torch.where(c > 0, c, c * act_alpha)
+    r = None
+    if pixel:
+        r = torch.rsqrt(torch.mean(a * a, dim=1, keepdim=True) + EPSILON)
+        a = a * r
+    if drop_noise is not None:
+        a = a * drop_noise
+    return a, r
+
+
+def activation_backward(o, r, grad, grad_r, act_alpha, drop_noise):
+    """
+    the gradient of activation_chain only in terms of its output o and the pixel norm r (which is also an output), so
+    nothing else has to be kept around, and only with differentiable ops so the gradient penalty can differentiate it
+    again (derivatives w.r.t o and r flow back into FusedActivation.backward)
+    """
+    y = o
+    if drop_noise is not None:
+        y = o / drop_noise  # the noise is strictly positive
+        grad = grad * drop_noise
+    if r is not None:
+        grad = r * (grad - y * torch.mean(grad * y, dim=1, keepdim=True))
+        if grad_r is not None:
+            grad = grad - r * r * y * grad_r / y.size(1)
+    if act_alpha >= 0:  # r and the noise are positive, so o > 0 is exactly c > 0
+        grad = torch.where(o > 0, grad, grad * act_alpha)
+    return grad
+
+
+def compile_errors():
+    """the errors of a missing or broken compiler backend, anything else is a real error and is raised as usual"""
+    import torch._dynamo.exc
+    import torch._inductor.exc
+    names = [(torch._dynamo.exc, 'TritonUnavailableError'), (torch._inductor.exc, 'InvalidCxxCompiler'),
+             (torch._inductor.exc, 'CppCompileError')]
+    return (torch._dynamo.exc.BackendCompilerFailed,) + tuple(getattr(m, n) for m, n in names if hasattr(m, n))
+
+
+def disable_compile(error):
+    global compile_enabled
+    compile_enabled = False
+    warnings.warn('torch.compile failed ({}: {}), falling back to the eager ops'.format(type(error).__name__, error))
+
+
+def run_compiled(fn, *args, compiled=True):
+    if compiled and compile_enabled:
+        if fn not in _compiled:
+            try:
+                _compiled[fn] = torch.compile(fn, dynamic=True)
+            except RuntimeError as e:  # torch.compile is not supported here (e.g. this python version)
+                disable_compile(e)
+                return fn(*args)
+        try:
+            return _compiled[fn](*args)
+        except compile_errors() as e:  # no working compiler backend here, stay with the eager ops from now on
+            disable_compile(e)
+    return fn(*args)
+
+
+class FusedActivation(Function):
+    """
+    activation_chain as a single autograd node which only keeps its output (that the next conv keeps anyway), the
+    pixel norm (one value per time step) and the seed of the gdrop noise, instead of an input and an output per op.
+    with compiled=True both passes run as one compiled kernel each, except for the backward pass of the gradient
+    penalty (create_graph=True) which needs the eager ops to build the graph of its double backward
+    """
+
+    @staticmethod
+    def forward(ctx, c, act_alpha, pixel, drop, compiled):
+        ctx.set_materialize_grads(False)
+        ctx.act_alpha = act_alpha
+        ctx.drop = drop
+        ctx.compiled = compiled
+        drop_noise = None if drop is None else gdrop_noise(*drop, like=c)
+        o, r = run_compiled(activation_forward, c, act_alpha, pixel, drop_noise, compiled=compiled)
+        ctx.save_for_backward(o, r)
+        return o if r is None else (o, r)
+
+    @staticmethod
+    def backward(ctx, grad, grad_r=None):
+        o, r = ctx.saved_tensors
+        if grad is None:
+            grad = torch.zeros_like(o)
+        drop_noise = None if ctx.drop is None else gdrop_noise(*ctx.drop, like=o)
+        grad = run_compiled(activation_backward, o, r, grad, grad_r, ctx.act_alpha, drop_noise,
+                            compiled=ctx.compiled and not torch.is_grad_enabled())
+        return grad, None, None, None, None
+
+
+def fused_activation(c, act_alpha, pixel=False, drop=None, compiled=True):
+    """drop is None or (noise shape, strength, seed) of a GDropLayer"""
+    out = FusedActivation.apply(c, act_alpha, pixel, drop, compiled)
+    return out[0] if pixel else out
+
+
+def test_fused_activation():
+    for act_alpha in [0.2, 0.0, -1]:
+        for pixel in [True, False]:
+            for drop in [((3, 5, 1), 0.2, 1373), None]:
+                c = torch.randn(3, 5, 7, dtype=torch.float64, requires_grad=True)
+                drop_noise = None if drop is None else gdrop_noise(*drop, like=c)
+                expected = activation_chain(c, act_alpha, pixel, drop_noise)
+                assert torch.allclose(fused_activation(c, act_alpha, pixel, drop, compiled=False), expected)
+
+                def f(x):
+                    return fused_activation(x, act_alpha, pixel, drop, compiled=False)
+
+                assert torch.autograd.gradcheck(f, (c,))
+                assert torch.autograd.gradgradcheck(f, (c,))
+    c = torch.randn(4, 8, 33, requires_grad=True)
+    drop = ((4, 8, 1), 0.2, 1373)
+    out = fused_activation(c, 0.2, True, drop)
+    expected = activation_chain(c, 0.2, True, gdrop_noise(*drop, like=c))
+    assert torch.allclose(out, expected, atol=1e-6)
+    g = torch.randn_like(out)
+    assert torch.allclose(torch.autograd.grad(out, c, g)[0], torch.autograd.grad(expected, c, g)[0], atol=1e-6)
+
+
+def test_run_compiled():
+    global compile_enabled
+    enabled = compile_enabled
+    try:
+        def fn(x):
+            return x + 1
+
+        def broken_backend(x):
+            raise compile_errors()[0](None, RuntimeError('no compiler'), None)
+
+        def broken_fn(x):
+            raise ValueError('not a compiler error')
+
+        compile_enabled = True
+        _compiled[broken_fn] = broken_fn
+        try:
+            run_compiled(broken_fn, torch.zeros(2))
+            assert False, 'the error should have been raised'
+        except ValueError:
+            pass
+        assert compile_enabled
+        _compiled[fn] = broken_backend
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            assert torch.equal(run_compiled(fn, torch.zeros(2)), torch.ones(2))
+        assert not compile_enabled and len(caught) == 1
+    finally:
+        compile_enabled = enabled
+        _compiled.pop(fn, None)
+        _compiled.pop(broken_fn, None)
+
+
+def main():
+    test_fused_activation()
+    test_run_compiled()
+
+
+if __name__ == '__main__':
+    main()
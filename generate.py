@@ -0,0 +1,562 @@
+import os
+import json
+import math
+import time
+import multiprocessing
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from layers import MinibatchStddev
+from utils import simple_argparser, get_half, truncated_normal, set_noise_seed
+
+default_params = dict(
+    mode='batch',  # batch (num_samples in shards), sweep (truncations and interpolations), drs or stream
+    checkpoint='',  # an exported generator (export.py) or a (smooth) generator checkpoint of a training run
+    config_file='',  # for checkpoints, empty means the conf.yml next to it
+    output_dir='samples',
+    num_samples=10000,
+    shard_size=1000,  # samples per shard, each shard is generated with its own seed so the order of work is free
+    batch_size=250,
+    num_workers=2,
+    threads_per_worker=0,  # 0 means the cpu count divided by num_workers
+    random_seed=1373,
+    output_format='npy',  # npy (a file per shard) or memmap (a single samples.dat of shape manifest['shape'])
+    dtype='float32',
+    cuda=False,
+    truncations=[0.5, 1.0, 2.0, 0.0],  # thresholds of the sweep, 0 means no truncation
+    num_paths=4,  # interpolation paths of the sweep, between two latents each
+    interpolation_steps=16,
+    discriminator='',  # the discriminator checkpoint of the drs mode
+    drs_calibration_samples=2000,  # held out samples that set the maximum logit and gamma of drs
+    drs_percentile=80.0,  # gamma is this percentile of F(x) over the calibration samples
+    drs_epsilon=1e-6,
+    stream_length=216000,  # output samples of each of the num_samples streamed recordings (an hour at 60Hz)
+    stream_chunk_steps=64,  # latent steps per window (exported generators have theirs fixed by export.py)
+    stream_context_steps=0,  # latent steps on each side of a window, 0 means enough for the receptive field
+    stream_overlap=0,  # cross faded output samples between windows, 0 means one latent step
+)
+
+MANIFEST = 'manifest.json'
+worker = {}
+
+
+def load_sampler(checkpoint, config_file='', device='cpu'):
+    """returns the generator as a function of (z, y) and its export_config"""
+    from export import load_exported, freeze_generator, load_generator, export_config
+
+    if checkpoint.endswith('.pt'):
+        model, config = load_exported(checkpoint, device)
+    else:
+        model = freeze_generator(load_generator(checkpoint, config_file)).to(device)
+        config = export_config(model)
+    return model, config
+
+
+def shard_seed(random_seed, shard):
+    """counter based, the seed of a shard only depends on its index (and not on which worker generates it)"""
+    return int(np.random.SeedSequence([random_seed, shard]).generate_state(1, np.uint64)[0] >> np.uint64(1))
+
+
+def sample_latents(config, batch_size, rng, device='cpu'):
+    """z in the z_distribution of the generator (and one hot class labels if it's conditional), drawn from rng"""
+    size = (batch_size, config['latent_size']) + ((config['initial_kernel_size'],) if config['conv_only'] else ())
+    if config['z_distribution'] == 'bernoulli':
+        z = torch.bernoulli(get_half(*size[:2]).expand(size), generator=rng)
+    else:
+        z = torch.randn(size, generator=rng)
+        if config['z_distribution'] == 'censored':
+            z = F.relu(z)
+    labels = None
+    if config['num_classes']:
+        labels = torch.randint(config['num_classes'], (batch_size,), generator=rng)
+    return z.to(device), labels
+
+
+def generate(model, config, z, labels):
+    inputs = (z,) if labels is None else (z, F.one_hot(labels, config['num_classes']).to(z))
+    with torch.no_grad():
+        return model(*inputs)
+
+
+def shard_range(params, shard):
+    start = shard * params['shard_size']
+    return start, min(start + params['shard_size'], params['num_samples'])
+
+
+def init_worker(params):
+    torch.set_num_threads(params['threads_per_worker'] or max(os.cpu_count() // max(params['num_workers'], 1), 1))
+    worker['device'] = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    worker['model'], worker['config'] = load_sampler(params['checkpoint'], params['config_file'], worker['device'])
+    worker['params'] = params
+    worker['shape'] = tuple(read_manifest(params['output_dir'])['shape'])
+
+
+def generate_shard(shard):
+    params, config = worker['params'], worker['config']
+    start, end = shard_range(params, shard)
+    seed = shard_seed(params['random_seed'], shard)
+    rng = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)  # the noise inside the generator, of traced ones
+    set_noise_seed(seed)  # and of the others (see utils.device_randn)
+    # all the latents of the shard up front, so they don't depend on the batch size (the noise of the generator does)
+    z, y = sample_latents(config, end - start, rng, worker['device'])
+    samples = []
+    for i in range(0, end - start, params['batch_size']):
+        batch = slice(i, i + params['batch_size'])
+        samples.append(generate(worker['model'], config, z[batch], None if y is None else y[batch])
+                       .cpu().numpy().astype(params['dtype']))
+    samples = np.concatenate(samples)
+    files = {}
+    if params['output_format'] == 'memmap':
+        out = np.memmap(os.path.join(params['output_dir'], 'samples.dat'), params['dtype'], 'r+',
+                        shape=worker['shape'])
+        out[start:end] = samples
+        out.flush()
+        files['samples'] = 'samples.dat'
+    else:
+        files['samples'] = save_atomically(params['output_dir'], 'samples-{:06}.npy'.format(shard), samples)
+    if y is not None:
+        files['labels'] = save_atomically(params['output_dir'], 'labels-{:06}.npy'.format(shard), y.cpu().numpy())
+    return shard, dict(start=start, count=end - start, seed=seed, **files)
+
+
+def save_atomically(directory, name, array):
+    """an interrupted run never leaves a truncated shard behind"""
+    tmp = os.path.join(directory, name + '.tmp.npy')
+    np.save(tmp, array)
+    os.replace(tmp, os.path.join(directory, name))
+    return name
+
+
+def read_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_dir, manifest):
+    tmp = os.path.join(output_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(output_dir, MANIFEST))
+
+
+def create_manifest(params):
+    """the settings that a resumed run has to share, the shape of the samples and the (so far) finished shards"""
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    model, config = load_sampler(params['checkpoint'], params['config_file'], device)
+    z, y = sample_latents(config, 1, torch.Generator().manual_seed(0), device)
+    shape = [params['num_samples']] + list(generate(model, config, z, y).shape[1:])
+    return dict(checkpoint=os.path.abspath(params['checkpoint']), num_samples=params['num_samples'],
+                shard_size=params['shard_size'], batch_size=params['batch_size'], random_seed=params['random_seed'],
+                output_format=params['output_format'], dtype=params['dtype'], shape=shape, config=config, shards={})
+
+
+def generate_batch(params):
+    os.makedirs(params['output_dir'], exist_ok=True)
+    manifest = read_manifest(params['output_dir'])
+    if manifest is None:
+        manifest = create_manifest(params)
+        if params['output_format'] == 'memmap':
+            np.memmap(os.path.join(params['output_dir'], 'samples.dat'), params['dtype'], 'w+',
+                      shape=tuple(manifest['shape'])).flush()
+        write_manifest(params['output_dir'], manifest)
+    else:
+        for key in ['num_samples', 'shard_size', 'batch_size', 'random_seed', 'output_format', 'dtype']:
+            if manifest[key] != params[key]:
+                raise ValueError('can not resume {} with {}={} (it was {})'.format(
+                    params['output_dir'], key, params[key], manifest[key]))
+    num_shards = (params['num_samples'] + params['shard_size'] - 1) // params['shard_size']
+    todo = [shard for shard in range(num_shards) if str(shard) not in manifest['shards']]
+    done_samples = sum(shard['count'] for shard in manifest['shards'].values())
+    if done_samples:
+        print('resuming, {} of {} samples are already generated'.format(done_samples, params['num_samples']))
+    start = time.perf_counter()
+    generated = 0
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(params['num_workers'], init_worker, (params,)) as pool, \
+            tqdm(total=params['num_samples'], initial=done_samples, unit='sample') as progress:
+        for shard, info in pool.imap_unordered(generate_shard, todo):
+            manifest['shards'][str(shard)] = info
+            write_manifest(params['output_dir'], manifest)
+            generated += info['count']
+            progress.update(info['count'])
+            progress.set_postfix(samples_per_sec='{:.1f}'.format(generated / (time.perf_counter() - start)))
+    report_throughput(generated, start)
+    return manifest
+
+
+def report_throughput(generated, start):
+    elapsed = time.perf_counter() - start
+    print('generated {} samples in {:.1f}s ({:.1f} samples/s)'.format(generated, elapsed,
+                                                                     generated / max(elapsed, 1e-9)))
+
+
+def slerp(z0, z1, t):  # N, L and steps -> N, steps, L
+    z0, z1, t = z0.unsqueeze(1), z1.unsqueeze(1), t.view(1, -1, 1)
+    cos = F.cosine_similarity(z0, z1, dim=2).clamp(-1, 1).unsqueeze(2)
+    omega = torch.acos(cos)
+    sin = torch.sin(omega).clamp_min(1e-6)
+    return torch.where(sin > 1e-6, (torch.sin((1 - t) * omega) * z0 + torch.sin(t * omega) * z1) / sin,
+                       (1 - t) * z0 + t * z1)
+
+
+def sweep_latents(config, params, chunk_size, rng, device):
+    """
+    the latents of one chunk for every truncation threshold, all from the same uniforms so the settings only differ by
+    their truncation, in a single (len(truncations) * chunk_size) batch
+    """
+    size = (chunk_size, config['latent_size']) + ((config['initial_kernel_size'],) if config['conv_only'] else ())
+    thresholds = torch.tensor([t if t > 0 else float('inf') for t in params['truncations']], device=device)
+    u = torch.rand(size, generator=rng, device=device)
+    z = truncated_normal(u.unsqueeze(0), thresholds.view(-1, *[1] * len(size)))  # S, chunk, L[, T]
+    labels = None
+    if config['num_classes']:
+        labels = torch.randint(config['num_classes'], (chunk_size,), generator=rng, device=device)
+        labels = labels.repeat(len(params['truncations']))
+    return z.reshape(-1, *size[1:]), labels
+
+
+def path_latents(config, params, rng, device):
+    """the spherical interpolations between pairs of untruncated latents, num_paths * interpolation_steps of them"""
+    size = (params['num_paths'], config['latent_size']) + (
+        (config['initial_kernel_size'],) if config['conv_only'] else ())
+    z0, z1 = [torch.randn(size, generator=rng, device=device) for _ in range(2)]
+    z = slerp(z0.flatten(1), z1.flatten(1), torch.linspace(0, 1, params['interpolation_steps'], device=device))
+    labels = None
+    if config['num_classes']:
+        labels = torch.randint(config['num_classes'], (params['num_paths'],), generator=rng, device=device)
+        labels = labels.repeat_interleave(params['interpolation_steps'])
+    return z.reshape(-1, *size[1:]), labels
+
+
+def generate_sweep(params):
+    """
+    num_samples for every truncation threshold and the interpolation paths, every generator pass evaluates all the
+    settings together (a chunk of batch_size // len(truncations) latents per threshold, the paths with the first one)
+    """
+    if not params['truncations'] and not params['num_paths']:
+        raise ValueError('the sweep needs truncations or num_paths')
+    if params['truncations'] and params['num_samples'] < 1:
+        raise ValueError('the truncations need num_samples >= 1')
+    if params['num_paths'] and params['interpolation_steps'] < 1:
+        raise ValueError('the interpolation paths need interpolation_steps >= 1')
+    os.makedirs(params['output_dir'], exist_ok=True)
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    model, config = load_sampler(params['checkpoint'], params['config_file'], device)
+    if config['z_distribution'] != 'normal':
+        raise ValueError('truncation is only defined for a normal z_distribution')
+    rng = torch.Generator(device=device).manual_seed(params['random_seed'])
+    torch.manual_seed(params['random_seed'])
+    set_noise_seed(params['random_seed'])
+    num_settings = len(params['truncations'])
+    chunk_size = max(params['batch_size'] // max(num_settings, 1), 1)
+    outputs = [[] for _ in range(num_settings)]
+    paths = None
+    start = time.perf_counter()
+    chunks = range(0, params['num_samples'], chunk_size) if num_settings else [params['num_samples']]
+    for i in tqdm(chunks, unit='chunk'):
+        chunk = min(chunk_size, params['num_samples'] - i)
+        parts = [sweep_latents(config, params, chunk, rng, device)] if num_settings else []
+        if paths is None and params['num_paths']:
+            parts.append(path_latents(config, params, rng, device))
+        z = torch.cat([p[0] for p in parts])
+        labels = None if parts[0][1] is None else torch.cat([p[1] for p in parts])
+        x = generate(model, config, z, labels).cpu().numpy().astype(params['dtype'])
+        for s in range(num_settings):
+            outputs[s].append(x[s * chunk:(s + 1) * chunk])
+        if paths is None and params['num_paths']:
+            paths = x[num_settings * chunk:].reshape(params['num_paths'], params['interpolation_steps'], *x.shape[1:])
+    summary = {}
+    for threshold, samples in zip(params['truncations'], outputs):
+        samples = np.concatenate(samples)
+        name = 'truncation-{}.npy'.format(threshold)
+        np.save(os.path.join(params['output_dir'], name), samples)
+        summary['truncation={}'.format(threshold)] = dict(file=name, count=len(samples), mean=float(samples.mean()),
+                                                          std=float(samples.std()),
+                                                          diversity=float(samples.std(axis=0).mean()))
+    if paths is not None:
+        np.save(os.path.join(params['output_dir'], 'interpolations.npy'), paths)
+        summary['interpolations'] = dict(file='interpolations.npy', shape=list(paths.shape))
+    with open(os.path.join(params['output_dir'], 'sweep.json'), 'w') as f:
+        json.dump(dict(params=params, config=config, settings=summary), f, indent=2)
+    report_throughput(params['num_samples'] * num_settings + params['num_paths'] * params['interpolation_steps'], start)
+    return summary
+
+
+def drs_scores(model, config, discriminator, z, labels):
+    """the samples of a candidate batch and their discriminator logits, generated and scored in one pass"""
+    with torch.no_grad():
+        x = generate(model, config, z, labels)
+        y = None if labels is None else F.one_hot(labels, config['num_classes']).to(x)
+        return x, discriminator(x, y)[0].view(-1).double()
+
+
+def drs_f(logits, max_logit, epsilon):
+    """F(x) = D(x) - D_M - log(1 - exp(D(x) - D_M - epsilon)) of discriminator rejection sampling"""
+    d = logits - max_logit
+    return d - torch.log1p(-torch.exp(d - epsilon))
+
+
+def candidate_batch_size(discriminator, batch_size):
+    """the minibatch stddev of the discriminator needs a batch size divisible by its group size"""
+    groups = [m.group_size for m in discriminator.modules() if isinstance(m, MinibatchStddev) and m.group_size > 0]
+    if groups and groups[0] < batch_size:
+        batch_size -= batch_size % int(groups[0])
+    return batch_size
+
+
+def generate_drs(params):
+    """
+    discriminator rejection sampling (Azadi et al.), the maximum logit D_M and gamma come from a held out calibration
+    batch and every candidate x is accepted with probability sigmoid(F(x) - gamma), while D_M keeps being updated
+    """
+    from export import load_discriminator
+
+    os.makedirs(params['output_dir'], exist_ok=True)
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    model, config = load_sampler(params['checkpoint'], params['config_file'], device)
+    discriminator = load_discriminator(params['discriminator'], params['config_file']).to(device)
+    batch_size = candidate_batch_size(discriminator, params['batch_size'])
+    rng = torch.Generator().manual_seed(params['random_seed'])
+    torch.manual_seed(params['random_seed'])
+    set_noise_seed(params['random_seed'])
+    start = time.perf_counter()
+    logits = torch.cat([drs_scores(model, config, discriminator, *sample_latents(config, batch_size, rng, device))[1]
+                        for _ in range(0, params['drs_calibration_samples'], batch_size)])
+    max_logit = logits.max()
+    gamma = torch.quantile(drs_f(logits, max_logit, params['drs_epsilon']), params['drs_percentile'] / 100.0)
+    calibration_time = time.perf_counter() - start
+    samples, labels = [], []
+    num_accepted = num_candidates = 0
+    start = time.perf_counter()
+    with tqdm(total=params['num_samples'], unit='sample') as progress:
+        while num_accepted < params['num_samples']:
+            z, y = sample_latents(config, batch_size, rng, device)
+            x, logits = drs_scores(model, config, discriminator, z, y)
+            max_logit = torch.max(max_logit, logits.max())
+            p = torch.sigmoid(drs_f(logits, max_logit, params['drs_epsilon']) - gamma).cpu()
+            accept = torch.rand(batch_size, generator=rng, dtype=torch.float64) < p
+            samples.append(x[accept.to(x.device)].cpu().numpy().astype(params['dtype']))
+            if y is not None:
+                labels.append(y[accept].numpy())
+            num_accepted += int(accept.sum())
+            num_candidates += batch_size
+            progress.update(min(int(accept.sum()), params['num_samples'] - progress.n))
+            progress.set_postfix(acceptance_rate='{:.3f}'.format(num_accepted / num_candidates))
+    elapsed = time.perf_counter() - start
+    np.save(os.path.join(params['output_dir'], 'samples.npy'), np.concatenate(samples)[:params['num_samples']])
+    if labels:
+        np.save(os.path.join(params['output_dir'], 'labels.npy'), np.concatenate(labels)[:params['num_samples']])
+    report = dict(acceptance_rate=num_accepted / num_candidates, candidates=num_candidates,
+                  samples_per_sec=params['num_samples'] / elapsed, candidates_per_sec=num_candidates / elapsed,
+                  calibration_sec=calibration_time, gamma=float(gamma), max_logit=float(max_logit))
+    with open(os.path.join(params['output_dir'], 'drs.json'), 'w') as f:
+        json.dump(dict(params=params, config=config, report=report), f, indent=2)
+    print('accepted {} of {} candidates ({:.3f}), {:.1f} samples/s'.format(
+        num_accepted, num_candidates, report['acceptance_rate'], report['samples_per_sec']))
+    return report
+
+
+def stream_chunks(model, config, z_source, chunk_steps, context_steps, overlap, labels=None):
+    """
+    yields the consecutive (B, C, chunk_steps * ratio) pieces of an endless recording of a conv_only generator, with
+    constant memory: each window of latents is chunk_steps long plus context_steps on both sides and moves by
+    chunk_steps (z_source(n) returns the next n latent steps), the outputs of neighbouring windows overlap by overlap
+    samples which are cross faded (sin^2 and cos^2, they add up to one). when the context covers the receptive field
+    and half the overlap, every window computes exactly what a single long generator pass would (stream_settings
+    checks that the settings fit together)
+    """
+    ratio = config['output_ratio']
+    hop, context = chunk_steps * ratio, context_steps * ratio
+    start = context - overlap // 2
+    z = z_source(chunk_steps + 2 * context_steps)
+    fade_in = None
+    tail = None
+    while True:
+        x = generate(model, config, z, labels)[:, :, start:start + hop + overlap]
+        if fade_in is None:
+            fade_in = torch.sin(math.pi / 2 * (torch.arange(overlap, device=x.device) + 0.5) / overlap) ** 2
+        head = x[:, :, :overlap] if tail is None else x[:, :, :overlap] * fade_in + tail * (1 - fade_in)
+        tail = x[:, :, hop:]
+        yield torch.cat([head, x[:, :, overlap:hop]], dim=2)
+        z = torch.cat([z[:, :, chunk_steps:], z_source(chunk_steps)], dim=2)
+
+
+def stream_settings(params, config):
+    """(chunk_steps, context_steps, overlap) of the stream mode"""
+    if not config['conv_only'] or config.get('receptive_field') is None:
+        raise ValueError('only conv_only generators without self attention can be streamed')
+    overlap = params['stream_overlap'] or config['output_ratio']
+    context_steps = params['stream_context_steps'] or config['receptive_field'] + math.ceil(
+        overlap / config['output_ratio'])
+    chunk_steps = params['stream_chunk_steps']
+    if params['checkpoint'].endswith('.pt'):  # the traced graph only takes its own latent length
+        chunk_steps = config['latent_steps'] - 2 * context_steps
+        if chunk_steps <= 0:
+            raise ValueError('export the generator with --latent_steps bigger than {}'.format(2 * context_steps))
+    if chunk_steps < 1 or context_steps < 0 or overlap < 1:
+        raise ValueError('the stream needs stream_chunk_steps >= 1, stream_context_steps >= 0 and stream_overlap >= 0')
+    hop, context = chunk_steps * config['output_ratio'], context_steps * config['output_ratio']
+    if overlap > hop or overlap - overlap // 2 > context:  # the cross fade has to fit into the window and its context
+        raise ValueError('stream_overlap={} is too long for {} latent steps per window and {} of context on each side'
+                         .format(overlap, chunk_steps, context_steps))
+    return chunk_steps, context_steps, overlap
+
+
+def generate_stream(params):
+    """num_samples recordings of stream_length samples each, batch_size of them at a time, into stream.npy"""
+    if params['num_samples'] < 1 or params['stream_length'] < 1:
+        raise ValueError('the stream needs num_samples >= 1 and stream_length >= 1')
+    os.makedirs(params['output_dir'], exist_ok=True)
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    model, config = load_sampler(params['checkpoint'], params['config_file'], device)
+    chunk_steps, context_steps, overlap = stream_settings(params, config)
+    rng = torch.Generator().manual_seed(params['random_seed'])
+    torch.manual_seed(params['random_seed'])
+    set_noise_seed(params['random_seed'])
+    out = None
+    start = time.perf_counter()
+    with tqdm(total=params['num_samples'] * params['stream_length'], unit='sample') as progress:
+        for first in range(0, params['num_samples'], params['batch_size']):
+            batch_size = min(params['batch_size'], params['num_samples'] - first)
+            labels = sample_latents(config, batch_size, rng, device)[1]
+
+            def z_source(steps):
+                z = sample_latents(dict(config, conv_only=True, initial_kernel_size=steps), batch_size, rng, device)
+                return z[0]
+
+            length = 0
+            for piece in stream_chunks(model, config, z_source, chunk_steps, context_steps, overlap, labels):
+                piece = piece[:, :, :params['stream_length'] - length].cpu().numpy().astype(params['dtype'])
+                if out is None:
+                    out = np.lib.format.open_memmap(os.path.join(params['output_dir'], 'stream.npy'), 'w+',
+                                                    params['dtype'], (params['num_samples'], piece.shape[1],
+                                                                      params['stream_length']))
+                out[first:first + batch_size, :, length:length + piece.shape[2]] = piece
+                length += piece.shape[2]
+                progress.update(piece.shape[0] * piece.shape[2])
+                if length == params['stream_length']:
+                    break
+    out.flush()
+    with open(os.path.join(params['output_dir'], 'stream.json'), 'w') as f:
+        json.dump(dict(params=params, config=config, chunk_steps=chunk_steps, context_steps=context_steps,
+                       overlap=overlap), f, indent=2)
+    report_throughput(params['num_samples'] * params['stream_length'], start)
+    return out
+
+
+def test_stream():
+    from export import freeze_generator, export_config, export_generator
+    from network import Generator
+
+    g = Generator(8, 3, 64, 32, 8, 3, [], [2, 3, 4], [1, 2, 3], False, False, True, 'kaiming_normal', 0.2, 0, False,
+                  'normal', latent_size=16, conv_only=True, act_norm='batch').double()
+    with torch.no_grad():
+        g.depth = g.max_depth
+        g(torch.randn(8, 16, 32, dtype=torch.float64))  # some batch norm statistics
+    model = freeze_generator(g)
+    config = export_config(g)
+    z = torch.randn(2, 16, 200, dtype=torch.float64)
+    expected = generate(model, config, z, None)
+    for chunk_steps, overlap in [(16, 0), (5, 4), (32, 12)]:
+        context_steps = config['receptive_field'] + math.ceil(overlap / config['output_ratio'])
+        steps = iter(range(-context_steps, 10 ** 6))  # the stream starts context_steps before z
+
+        def z_source(n):
+            return torch.cat([z[:, :, max(next(steps), 0):][:, :, :1] for _ in range(n)], dim=2)
+
+        pieces = stream_chunks(model, config, z_source, chunk_steps, context_steps, overlap)
+        x = torch.cat([next(pieces) for _ in range(150 // chunk_steps)], dim=2)
+        # the stream starts overlap // 2 samples before z, the edges of both (zero padding and the repeated first
+        # latent step) differ
+        edge = config['receptive_field'] * config['output_ratio']
+        length = x.size(2) - overlap // 2 - 2 * edge
+        assert torch.allclose(x[:, :, edge + overlap // 2:][:, :, :length], expected[:, :, edge:edge + length],
+                              atol=1e-10), (chunk_steps, overlap)
+    traced = export_generator(g, latent_steps=40)
+    config = export_config(g, latent_steps=40)
+    chunk_steps, context_steps, overlap = stream_settings(dict(default_params, checkpoint='generator.pt'), config)
+    pieces = stream_chunks(traced, config, lambda n: torch.randn(2, 16, n, dtype=torch.float64), chunk_steps,
+                           context_steps, overlap)
+    assert next(pieces).shape == (2, 3, chunk_steps * config['output_ratio'])
+
+
+def test_shard():
+    import tempfile
+    from torch import nn
+    from export import freeze_generator, export_config
+    from network import Generator
+
+    g = Generator(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3], progression_scale_down=[1, 2], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16,
+                  self_attention_layers=[], separable=False, equalized=True, per_channel_noise=True, num_classes=0)
+    for p in g.parameters():  # the noise weights start at zero
+        nn.init.normal_(p)
+    g.depth = g.max_depth
+    with tempfile.TemporaryDirectory() as directory:
+        worker.update(model=freeze_generator(g), config=export_config(g), device='cpu',
+                      params=dict(default_params, output_dir=directory, num_samples=8, shard_size=4, batch_size=3))
+        first = np.load(os.path.join(directory, generate_shard(0)[1]['samples']))
+        generate_shard(1)  # the noise stream goes on in between
+        again = np.load(os.path.join(directory, generate_shard(0)[1]['samples']))
+    worker.clear()
+    assert np.array_equal(first, again)
+    g = Generator(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3], progression_scale_down=[1, 2], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16,
+                  self_attention_layers=[], separable=False, equalized=True, per_channel_noise=False, num_classes=3)
+    g.depth = g.max_depth
+    shards = []
+    for batch_size in [3, 8]:  # without noise inside the generator the samples don't depend on the batch size
+        with tempfile.TemporaryDirectory() as directory:
+            worker.update(model=freeze_generator(g), config=export_config(g), device='cpu',
+                          params=dict(default_params, output_dir=directory, num_samples=8, shard_size=8,
+                                      batch_size=batch_size))
+            files = generate_shard(0)[1]
+            shards.append([np.load(os.path.join(directory, files[k])) for k in ['samples', 'labels']])
+        worker.clear()
+    assert all(np.allclose(a, b, atol=1e-6) for a, b in zip(*shards))
+
+
+def test_param_checks():
+    for mode, settings in [('sweep', dict(truncations=[], num_paths=0)), ('sweep', dict(num_samples=0)),
+                           ('sweep', dict(truncations=[], interpolation_steps=0)),
+                           ('stream', dict(num_samples=0)), ('stream', dict(stream_length=0))]:
+        try:
+            main(dict(default_params, mode=mode, **settings))
+            assert False, (mode, settings)
+        except ValueError:
+            pass
+    config = dict(conv_only=True, receptive_field=4, output_ratio=8)
+    for settings in [dict(stream_chunk_steps=0), dict(stream_chunk_steps=-1), dict(stream_context_steps=-1),
+                     dict(stream_overlap=-8), dict(stream_chunk_steps=1, stream_overlap=9),
+                     dict(stream_context_steps=1, stream_overlap=24)]:
+        try:
+            stream_settings(dict(default_params, **settings), config)
+            assert False, settings
+        except ValueError:
+            pass
+    assert stream_settings(default_params, config) == (64, 5, 8)
+
+
+def main(params):
+    if params['mode'] == 'stream':
+        return generate_stream(params)
+    if params['mode'] == 'sweep':
+        return generate_sweep(params)
+    if params['mode'] == 'drs':
+        return generate_drs(params)
+    if params['mode'] == 'batch':
+        return generate_batch(params)
+    raise ValueError('invalid mode: {}'.format(params['mode']))
+
+
+if __name__ == '__main__':
+    main(simple_argparser(default_params))
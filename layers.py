@@ -5,8 +5,12 @@ from torch import nn
 import torch.nn.functional as F
 from torch.nn.init import calculate_gain
 from torch.nn.utils import spectral_norm
+from torch.nn.utils.spectral_norm import SpectralNorm
+from torch.utils.checkpoint import checkpoint
 
-from utils import pixel_norm, resample_signal, expand3d
+from fused import fused_activation, gdrop_noise
+from utils import pixel_norm, resample_signal, expand3d, next_noise_seed, set_noise_seed, get_noise_state, \
+    set_noise_state
 
 
 class PixelNorm(nn.Module):
@@ -29,41 +33,70 @@ class GDropLayer(nn.Module):
         self.strength = strength
         self.axes = [axes] if isinstance(axes, int) else list(axes)
 
+    def noise_args(self, x):
+        """(shape, strength, seed) of the noise for x, the seed is all it takes to draw the same noise again"""
+        rnd_shape = tuple(s if axis in self.axes else 1 for axis, s in enumerate(x.size()))
+        return rnd_shape, self.strength, next_noise_seed()
+
     def forward(self, x, deterministic=False):
         if deterministic or not self.strength:
             return x
-        rnd_shape = [s if axis in self.axes else 1 for axis, s in enumerate(x.size())]
-        rnd = (1 + self.strength) ** np.random.normal(size=rnd_shape)
-        rnd = torch.from_numpy(rnd).type(x.data.type()).to(x)
-        return x * rnd
+        return x * gdrop_noise(*self.noise_args(x), like=x)
+
+
+def attend(query, key, value, scale):  # BdT BdT[/4] BcT[/4] -> BcT
+    return torch.bmm(value, F.softmax(torch.bmm(key.permute(0, 2, 1), query) / scale, dim=1))
 
 
 class SelfAttention(nn.Module):
-    def __init__(self, channels_in, spectral, init='xavier_uniform'):
+    def __init__(self, channels_in, spectral, init='xavier_uniform', query_chunk_size=1024):
+        """
+        :param query_chunk_size: int, while training the attention is computed (and recomputed in the backward pass)
+         this many queries at a time, so the whole T[/4] x T matrix is never kept, 0 means all at once
+        """
         super().__init__()
         d_key = max(channels_in // 8, 2)
         conv_conf = dict(kernel_size=1, equalized=False, spectral=spectral,
                          init=init, bias=False, act_alpha=-1)
         self.gamma = nn.Parameter(torch.tensor(0.), requires_grad=True)
-        self.pooling = nn.MaxPool1d(4)
+        self.pooling_size = 4
         self.key_conv = GeneralConv(channels_in, d_key, **conv_conf)
         self.query_conv = GeneralConv(channels_in, d_key, **conv_conf)
         self.value_conv = GeneralConv(channels_in, channels_in // 2, **conv_conf)
         self.final_conv = GeneralConv(channels_in // 2, channels_in, **conv_conf)
-        self.softmax = nn.Softmax(dim=-1)
         self.scale = 1.0
+        self.query_chunk_size = query_chunk_size
+        self.return_attention = False  # only for visualization, it materializes the whole attention matrix
+
+    def pooling(self, h):
+        return F.max_pool1d(h, min(self.pooling_size, h.size(2)))
 
     def forward(self, x):  # BCT
         query = self.query_conv(x)  # BC/8T
         key = self.pooling(self.key_conv(x))  # BC/8T[/4]
         value = self.pooling(self.value_conv(x))  # BC/2T[/4]
-        out = F.softmax(torch.bmm(key.permute(0, 2, 1), query) / self.scale, dim=1)  # Bnormed(T[/4])T
-        attention_map = out
-        out = torch.bmm(value, out)  # BC/2T
+        attention_map = None
+        if self.return_attention:
+            attention_map = F.softmax(torch.bmm(key.permute(0, 2, 1), query) / self.scale, dim=1)  # Bnormed(T[/4])T
+            out = torch.bmm(value, attention_map)  # BC/2T
+        elif not torch.is_grad_enabled():
+            out = F.scaled_dot_product_attention(query.permute(0, 2, 1), key.permute(0, 2, 1),
+                                                 value.permute(0, 2, 1), scale=1.0 / self.scale).permute(0, 2, 1)
+        else:  # checkpointing keeps only one chunk of the matrix alive, even in the double backward of the gp
+            chunk_size = self.query_chunk_size or query.size(2)
+            out = torch.cat([checkpoint(attend, q, key, value, self.scale, use_reentrant=False)
+                             for q in query.split(chunk_size, dim=2)], dim=2)
         out = self.final_conv(out)  # BCT
         return self.gamma * out + x, attention_map
 
 
+def set_return_attention(network, enabled=True):
+    """makes the SelfAttention layers of the network return their attention maps (for visualization)"""
+    for module in network.modules():
+        if isinstance(module, SelfAttention):
+            module.return_attention = enabled
+
+
 class MinibatchStddev(nn.Module):
     def __init__(self, group_size=4, temporal_groups_per_window=1, kernel_size=32):
         super().__init__()
@@ -77,17 +110,16 @@ class MinibatchStddev(nn.Module):
         # make sure that B is divisible by G
         s = x.size()
         group_size = min(s[0], self.group_size)
-        all_y = []
-        for i in range(int(np.ceil(s[2] / self.stride_size))):
-            y = x[..., i * self.stride_size:(i + 1) * self.stride_size]
-            T = y.size(-1)
-            y = y.view(group_size, -1, s[1], T)  # G,B//G,C,T
-            y = y - y.mean(dim=0, keepdim=True)  # G,B//G,C,T
-            y = torch.sqrt((y ** 2).mean(dim=0))  # B//G,C,T
-            y = y.mean(dim=1, keepdim=True).mean(dim=2, keepdim=True)  # B//G,1,1
-            y = y.repeat((group_size, 1, T))  # B,1,T
-            all_y.append(y)
-        return torch.cat([x, torch.cat(all_y, dim=2)], dim=1)
+        stride_size = min(self.stride_size, s[2])
+        y = x.view(group_size, -1, s[1], s[2])  # G,B//G,C,T
+        y = y - y.mean(dim=0, keepdim=True)  # G,B//G,C,T
+        y = torch.sqrt((y ** 2).mean(dim=0))  # B//G,C,T
+        y = y.mean(dim=1, keepdim=True)  # B//G,1,T
+        # average over each temporal window (the last one can be shorter) and put it back on every time step
+        y = F.avg_pool1d(y, stride_size, stride_size, ceil_mode=True)  # B//G,1,ceil(T/stride)
+        y = y.repeat_interleave(stride_size, dim=2)[..., :s[2]]  # B//G,1,T
+        y = y.repeat((group_size, 1, 1))  # B,1,T
+        return torch.cat([x, y], dim=1)
 
 
 class ConditionalBatchNorm(nn.Module):
@@ -114,26 +146,76 @@ class ConditionalBatchNorm(nn.Module):
             else:
                 self.mode = 'CSM'  # conditional self modulation(biggan)
 
-    def forward(self, x, y, z):  # y = B*num_classes*Ty ; x = B*num_features*Tx ; z = B*latent_size
-        out = self.normalizer(x)
-        if self.mode == 'BN':
-            return out
+    def condition(self, y, z):
+        """the input of self.embed"""
         if y is not None and y.ndimension() == 2:
             y = y.unsqueeze(2)
         if self.mode == 'CBN':
-            cond = y
-        else:
-            if self.mode == 'CSM':
-                z = expand3d(z)
-                cond = torch.cat([resample_signal(z, z.size(2), y.size(2)), y], dim=1)
-            else:  # 'SM'
-                cond = expand3d(z)
-        embed = self.embed(cond)  # B, num_features*2, Ty
-        embed = resample_signal(embed, embed.shape[2], out.shape[2])
+            return y
+        z = expand3d(z)
+        if self.mode == 'CSM':
+            return torch.cat([resample_signal(z, z.size(2), y.size(2)), y], dim=1)
+        return z  # 'SM'
+
+    def embed_layers(self):
+        return [self.embed] if self.mode == 'CBN' else list(self.embed)
+
+    def forward(self, x, y, z, embed=None):  # y = B*num_classes*Ty ; x = B*num_features*Tx ; z = B*latent_size
+        """embed is the output of self.embed when it's already computed (see batched_embeddings)"""
+        out = self.normalizer(x)
+        if self.mode == 'BN':
+            return out
+        if embed is None:
+            embed = self.embed(self.condition(y, z))  # B, num_features*2, Ty
+        if embed.size(2) != 1:  # a global condition is just broadcast
+            embed = resample_signal(embed, embed.shape[2], out.shape[2])
         gamma, beta = embed.chunk(2, dim=1)
         return out + gamma * out + beta  # trick to make sure gamma is 1.0 at the beginning of the training
 
 
+def batched_linear(inputs, layers):
+    """
+    applies the 1x1 GeneralConvs to their (N, C) inputs, with one matmul (of the concatenated weights) per input that
+    is shared between layers and one bmm per group of equally shaped layers for the rest
+    """
+    outputs = [None] * len(inputs)
+    shared = {}
+    for i, x in enumerate(inputs):
+        shared.setdefault(id(x), []).append(i)
+    stacked = {}
+    for indices in shared.values():
+        weights = [layers[i].conv.conv.effective_weight()[:, :, 0] for i in indices]
+        biases = [layers[i].conv.conv.bias for i in indices]
+        if len(indices) == 1:
+            stacked.setdefault((inputs[indices[0]].size(), weights[0].size()), []).append(
+                (indices[0], weights[0], biases[0]))
+            continue
+        bias = None if biases[0] is None else torch.cat(biases)
+        out = F.linear(inputs[indices[0]], torch.cat(weights), bias)
+        for i, o in zip(indices, out.split([w.size(0) for w in weights], dim=1)):
+            outputs[i] = o
+    for group in stacked.values():
+        indices, weights, biases = zip(*group)
+        out = torch.bmm(torch.stack([inputs[i] for i in indices]), torch.stack(weights).transpose(1, 2))
+        if biases[0] is not None:
+            out = out + torch.stack(biases).unsqueeze(1)
+        for i, o in zip(indices, out.unbind(0)):
+            outputs[i] = o
+    return [layer.net(o) for layer, o in zip(layers, outputs)]
+
+
+def batched_embeddings(norms, conds):
+    """
+    the embed networks of ConditionalBatchNorms (all in the same mode) on their conditions, which should be the same
+    tensor wherever they are equal, instead of a few tiny matmuls per norm
+    """
+    hs = {id(c): c.permute(0, 2, 1).reshape(-1, c.size(1)) for c in conds}  # B*Ty, C
+    hs = [hs[id(c)] for c in conds]
+    for layers in zip(*[norm.embed_layers() for norm in norms]):
+        hs = batched_linear(hs, layers)
+    return [h.view(c.size(0), c.size(2), -1).permute(0, 2, 1) for h, c in zip(hs, conds)]
+
+
 class EqualizedSeparableConv1d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,
                  padding, spectral, equalized, init, act_alpha, bias, groups, stride):
@@ -147,12 +229,38 @@ class EqualizedSeparableConv1d(nn.Module):
         return self.net(x)
 
 
+class ScaledConv1d(nn.Conv1d):
+    """
+    Conv1d with a constant multiplier for its weight, it's applied inside forward so spectral_norm (which sets
+    self.weight in a pre forward hook) keeps working. the multiplier is a buffer so the checkpoints have it, it comes
+    from the random initialization and can't be computed again
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_buffer('scale', torch.tensor(1.0))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the buffer keep the scale of the initialization (train.py seeds it)
+        state_dict.setdefault(prefix + 'scale', self.scale)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def effective_weight(self):
+        """the weight forward applies, after running the pre forward hooks (spectral_norm's power iteration)"""
+        for hook in self._forward_pre_hooks.values():
+            hook(self, None)
+        return self.weight * self.scale
+
+    def forward(self, x):
+        return self._conv_forward(x, self.weight * self.scale, self.bias)
+
+
 class EqualizedConv1d(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, padding,
                  spectral, equalized, init, act_alpha, bias, groups, stride):
         super().__init__()
-        self.conv = nn.Conv1d(in_channels=in_channels, out_channels=out_channels, stride=stride,
-                              kernel_size=kernel_size, padding=padding, bias=bias, groups=groups)
+        self.conv = ScaledConv1d(in_channels=in_channels, out_channels=out_channels, stride=stride,
+                                 kernel_size=kernel_size, padding=padding, bias=bias, groups=groups)
         if bias:
             self.conv.bias.data.zero_()
         act_alpha = act_alpha if act_alpha > 0 else 1
@@ -162,22 +270,26 @@ class EqualizedConv1d(nn.Module):
             torch.nn.init.xavier_uniform_(self.conv.weight, gain=calculate_gain('leaky_relu', param=act_alpha))
         elif init == 'orthogonal':
             torch.nn.init.orthogonal_(self.conv.weight, gain=calculate_gain('leaky_relu', param=act_alpha))
-        if not equalized:
-            self.scale = 1.0
-        else:
-            self.scale = ((torch.mean(self.conv.weight.data ** 2)) ** 0.5).item()
-        self.conv.weight.data.copy_(self.conv.weight.data / self.scale)
+        if equalized:
+            scale = ((torch.mean(self.conv.weight.data ** 2)) ** 0.5).item()
+            self.conv.weight.data.copy_(self.conv.weight.data / scale)
+            # scaling the weight instead of the input is the same but costs O(parameters) instead of O(activations)
+            self.conv.scale.fill_(scale)
         if spectral:
             self.conv = spectral_norm(self.conv)
 
+    @property
+    def scale(self):
+        return self.conv.scale.item()
+
     def forward(self, x):
-        return self.conv(x * self.scale)
+        return self.conv(x)
 
 
 class GeneralConv(nn.Module):
     def __init__(self, in_channels, out_channels, z_to_bn_size=0, kernel_size=3, equalized=True,
                  pad=None, act_alpha=0.2, do=0, num_classes=0, act_norm=None, spectral=False,
-                 init='kaiming_normal', bias=True, separable=False, stride=1):
+                 init='kaiming_normal', bias=True, separable=False, stride=1, fused=False):
         super().__init__()
         pad = (kernel_size - 1) // 2 if pad is None else pad
         if separable:
@@ -195,22 +307,79 @@ class GeneralConv(nn.Module):
         self.net = []
         if act_alpha >= 0:
             if act_alpha == 0:
-                self.net.append(nn.ReLU())  # DO NOT use inplace, gradient penalty will break
+                self.net.append(nn.ReLU())
             else:
-                self.net.append(nn.LeakyReLU(act_alpha))  # DO NOT use inplace, gradient penalty will break
+                self.net.append(nn.LeakyReLU(act_alpha))
         if act_norm == 'pixel':
             self.net.append(PixelNorm())
         if do != 0:
             self.net.append(GDropLayer(strength=do))
+        # self.net is what forward computes, but with fused_activation which keeps much less for the backward pass
+        # (and runs as compiled kernels when fused=True)
         self.net = nn.Sequential(*self.net)
+        self.fused = fused
+        self.act_alpha = act_alpha
+        self.pixel = act_norm == 'pixel'
+        self.drop = self.net[-1] if do != 0 else None
 
-    def forward(self, x, y=None, z=None, conv_noise=None):
+    def forward(self, x, y=None, z=None, conv_noise=None, embed=None):
         c = self.conv(x)
         if conv_noise is not None:
             c = c * conv_noise
         if self.norm:
-            c = self.norm(c, y, z)
-        return self.net(c)
+            c = self.norm(c, y, z, embed)
+        if len(self.net) == 0:
+            return c
+        if torch.jit.is_tracing():  # a traced graph (see export.py) can't hold the autograd function
+            return self.net(c)
+        drop = self.drop.noise_args(c) if self.drop is not None and self.drop.strength else None
+        return fused_activation(c, self.act_alpha, self.pixel, drop, self.fused)
+
+
+class Replay(object):
+    """
+    calls module, and when it's called again (the recomputation of a checkpoint) redoes the first call exactly: with
+    the same noise seeds and from the same spectral norm power iteration vectors, after which the buffers (the power
+    iteration vectors and the batch norm running statistics) are put back so they are not updated twice
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.noise_state = get_noise_state()
+        self.vectors = [getattr(m, hook.name + suffix) for m in module.modules()
+                        for hook in m._forward_pre_hooks.values() if isinstance(hook, SpectralNorm)
+                        for suffix in ['_u', '_v']]
+        self.initial_vectors = [v.clone() for v in self.vectors]
+        self.buffers = self.vectors + [b for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+                                       for b in m.buffers()]
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            return self.module(*args, **kwargs)
+        noise_state, buffers = get_noise_state(), [b.clone() for b in self.buffers]
+        set_noise_state(self.noise_state)
+        with torch.no_grad():
+            for v, initial in zip(self.vectors, self.initial_vectors):
+                v.copy_(initial)
+        try:
+            return self.module(*args, **kwargs)
+        finally:
+            set_noise_state(noise_state)
+            with torch.no_grad():
+                for b, saved in zip(self.buffers, buffers):
+                    b.copy_(saved)
+
+
+def checkpointed(module, *args, **kwargs):
+    """
+    module(*args, **kwargs) without keeping its activations, they are recomputed in the backward pass (non reentrant
+    checkpointing, so the double backward of the gradient penalty works too)
+    """
+    if not torch.is_grad_enabled():
+        return module(*args, **kwargs)
+    return checkpoint(Replay(module), *args, use_reentrant=False, **kwargs)
 
 
 class PassChannelResidual(nn.Module):
@@ -237,3 +406,150 @@ class ConcatResidual(nn.Module):
         if self.net:
             return h + torch.cat([x, self.net(x)], dim=1)
         return h + x
+
+
+def test_minibatch_stddev():
+    def loop_minibatch_stddev(layer, x):  # the original per window implementation
+        s = x.size()
+        group_size = min(s[0], layer.group_size)
+        all_y = []
+        for i in range(int(np.ceil(s[2] / layer.stride_size))):
+            y = x[..., i * layer.stride_size:(i + 1) * layer.stride_size]
+            T = y.size(-1)
+            y = y.view(group_size, -1, s[1], T)
+            y = y - y.mean(dim=0, keepdim=True)
+            y = torch.sqrt((y ** 2).mean(dim=0))
+            y = y.mean(dim=1, keepdim=True).mean(dim=2, keepdim=True)
+            y = y.repeat((group_size, 1, T))
+            all_y.append(y)
+        return torch.cat([x, torch.cat(all_y, dim=2)], dim=1)
+
+    for group_size in [0, 1, 2, 4, 8]:
+        for temporal_groups_per_window in [1, 2, 3, 4, 32]:
+            for kernel_size in [1, 7, 32]:
+                for seq_len in [1, 5, 32, 100, 257]:
+                    layer = MinibatchStddev(group_size, temporal_groups_per_window, kernel_size)
+                    if layer.stride_size == 0:
+                        continue
+                    x = torch.randn(8, 3, seq_len, dtype=torch.float64)
+                    expected = loop_minibatch_stddev(layer, x)
+                    result = layer(x)
+                    assert result.size() == expected.size()
+                    assert torch.allclose(result, expected, rtol=1e-10, atol=1e-12), (
+                        group_size, temporal_groups_per_window, kernel_size, seq_len)
+    assert MinibatchStddev(-1)(x) is x
+
+
+def test_equalized_conv():
+    for equalized in [False, True]:
+        for spectral in [False, True]:
+            for groups in [1, 4]:
+                layer = EqualizedConv1d(8, 12, 3, 1, spectral, equalized, 'kaiming_normal', 0.2, True, groups, 1)
+                layer = layer.double().eval()
+                x = torch.randn(5, 8, 17, dtype=torch.float64, requires_grad=True)
+                out = layer(x)  # spectral_norm sets conv.weight here
+                conv = layer.conv
+                # the original implementation scaled the input
+                expected = nn.Conv1d._conv_forward(conv, x * layer.scale, conv.weight, conv.bias)
+                assert torch.allclose(out, expected, atol=1e-12)
+                g = torch.randn_like(out)
+                inputs = [x] + list(layer.parameters())
+                grads = torch.autograd.grad(out, inputs, g, retain_graph=True)
+                expected_grads = torch.autograd.grad(expected, inputs, g)
+                for grad, expected_grad in zip(grads, expected_grads):
+                    assert torch.allclose(grad, expected_grad, atol=1e-12), (equalized, spectral, groups)
+                # the scale is saved, another initialization gets it from the state dict
+                other = EqualizedConv1d(8, 12, 3, 1, spectral, equalized, 'kaiming_normal', 0.2, True, groups, 1)
+                other = other.double().eval()
+                other.load_state_dict(layer.state_dict())
+                assert other.scale == layer.scale
+                with torch.no_grad():
+                    assert torch.allclose(other(x), layer(x), atol=1e-12)
+                # checkpoints from before keep the scale of the initialization
+                legacy = {k: v for k, v in layer.state_dict().items() if not k.endswith('scale')}
+                scale = other.scale
+                other.load_state_dict(legacy)
+                assert other.scale == scale
+
+
+def test_fused_general_conv():
+    def saved_numel(fn):
+        saved = {}
+
+        def pack(t):
+            saved[t.data_ptr()] = t.numel()
+            return t
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            out = fn()
+        saved.pop(out.data_ptr(), None)  # the next layer keeps it anyway
+        return sum(saved.values())
+
+    for act_alpha in [0.2, 0.0]:
+        for act_norm in ['pixel', None]:
+            layer = GeneralConv(6, 8, act_alpha=act_alpha, act_norm=act_norm, do=0.2).double()
+            x = torch.randn(4, 6, 21, dtype=torch.float64, requires_grad=True)
+            outputs, grads = [], []
+            for fused in [None, False, True]:
+                set_noise_seed(0)
+                if fused is None:
+                    out = layer.net(layer.conv(x))
+                else:
+                    layer.fused = fused
+                    out = layer(x)
+                # the gradient penalty takes the gradient of a gradient
+                g, = torch.autograd.grad((out ** 2).sum(), x, create_graph=True)
+                grads.append(torch.autograd.grad((g ** 2).sum(), [x] + list(layer.parameters())))
+                outputs.append(out)
+            for i in [1, 2]:
+                assert torch.allclose(outputs[0], outputs[i], atol=1e-6)
+                for expected, result in zip(grads[0], grads[i]):
+                    assert torch.allclose(expected, result, atol=1e-6), (act_alpha, act_norm, i)
+            c = layer.conv(x).detach().requires_grad_()
+            lean = saved_numel(lambda: fused_activation(c, act_alpha, layer.pixel, layer.drop.noise_args(c), False))
+            assert lean < saved_numel(lambda: layer.net(c)) and lean <= c.numel() // c.size(1)
+
+
+def test_noise_seed():
+    layer = GDropLayer(0.2)
+    x = torch.randn(4, 6, 9)
+    outputs = []
+    for rank in [0, 0, 1]:
+        set_noise_seed(1373, rank)
+        outputs.append(torch.stack([layer(x) for _ in range(3)]))
+    assert torch.equal(outputs[0], outputs[1]) and not torch.equal(outputs[0], outputs[2])
+    assert not torch.equal(outputs[0][0], outputs[0][1])
+
+
+def test_self_attention():
+    for seq_len in [1, 3, 8, 13, 61]:
+        layer = SelfAttention(16, False).double()
+        layer.query_chunk_size = 5
+        nn.init.normal_(layer.gamma)
+        x = torch.randn(3, 16, seq_len, dtype=torch.float64, requires_grad=True)
+        layer.return_attention = True
+        expected, attention_map = layer(x)
+        assert attention_map.size() == (3, max(seq_len // 4, 1), seq_len)
+        layer.return_attention = False
+        out, attention_map = layer(x)
+        assert attention_map is None and torch.allclose(out, expected, atol=1e-12)
+        with torch.no_grad():
+            assert torch.allclose(layer(x)[0], expected, atol=1e-12)
+
+        def f(x):
+            return layer(x)[0]
+
+        if seq_len == 13:  # three chunks
+            assert torch.autograd.gradgradcheck(f, (x[:1].detach().requires_grad_(),))
+
+
+def main():
+    test_noise_seed()
+    test_self_attention()
+    test_equalized_conv()
+    test_fused_general_conv()
+    test_minibatch_stddev()
+
+
+if __name__ == '__main__':
+    main()
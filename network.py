@@ -1,13 +1,32 @@
+import math
 import torch
 import itertools
+from fractions import Fraction
 import numpy as np
 from torch import nn
 from tqdm import tqdm, trange
 from torch.nn.utils import spectral_norm
 
 from cpc.cpc_network import SincEncoder
-from utils import pixel_norm, resample_signal
-from layers import GeneralConv, SelfAttention, MinibatchStddev, ScaledTanh, PassChannelResidual, ConcatResidual
+from utils import pixel_norm, resample_signal, device_randn, set_noise_seed
+from layers import GeneralConv, SelfAttention, MinibatchStddev, ScaledTanh, PassChannelResidual, ConcatResidual, \
+    batched_embeddings, checkpointed
+
+
+def progressive_parameters(network, depth, depth_modules):
+    """
+    the parameters that the network starts to use at the given depth, depth_modules(d) returns the modules which
+    are added at depth d >= 1 and depth 0 gets every other parameter
+    """
+    if depth != 0:
+        return [p for m in depth_modules(depth) for p in m.parameters()]
+    later = {id(p) for d in range(1, network.max_depth + 1) for m in depth_modules(d) for p in m.parameters()}
+    return [p for p in network.parameters() if id(p) not in later]
+
+
+def run_block(block, checkpoint, *args, **kwargs):
+    """block(*args, **kwargs), checkpointed (its activations are recomputed in the backward pass) if checkpoint"""
+    return checkpointed(block, *args, **kwargs) if checkpoint else block(*args, **kwargs)
 
 
 class UnetBlock(nn.Module):
@@ -19,8 +38,6 @@ class UnetBlock(nn.Module):
         self.split_z_size = split_z_size
         self.ch_out = ch_out
         self.ch_in = ch_in
-        self.dec_sa = SelfAttention(self.ch_out,
-                                    dec_layer_settings['spectral'], dec_layer_settings['init']) if has_sa else None
         self.input_to_all_layers = input_to_all_layers
         self.enc_ch_out = inner_layer.ch_in if inner_layer is not None else (ch_in + ch_out)
         self.enc_sa = SelfAttention(self.enc_ch_out,
@@ -31,39 +48,48 @@ class UnetBlock(nn.Module):
         self.inner_freq = inner_freq
         self.middle = inner_layer
         self.dec_ch_in = self.enc_ch_out + (inner_layer.ch_out if inner_layer is not None else 0)
+        self.dec_sa = SelfAttention(self.dec_ch_in,
+                                    dec_layer_settings['spectral'], dec_layer_settings['init']) if has_sa else None
         self.decoder = GBlock(self.dec_ch_in, ch_out, ch_rgb_out, k_size,
                               initial_kernel_size if not conv_only else None, is_residual,
                               no_tanh, deep, per_channel_noise, to_rgb_mode, **dec_layer_settings)
 
-    def forward(self, rgb_in, encoded, all_rgbs, alpha=1.0, is_first=False, y=None, z=None):
-        if is_first:
-            encoded = self.encoder.from_rgb(rgb_in)
-        elif self.input_to_all_layers:
-            encoded = (self.encoder.from_rgb(rgb_in) + encoded) / 2.0
+    def forward(self, rgbs, encoded, all_rgbs, alpha=1.0, is_first=False, y=None, z=None, from_rgb=None):
+        """
+        :param rgbs: list, the input pyramid, rgbs[0] is the input of this block, rgbs[1] of its middle and so on,
+         with Nones where they are not used (see Unet.input_pyramid)
+        :param from_rgb: self.encoder.from_rgb(rgbs[0]) when it's already computed
+        """
+        if is_first or self.input_to_all_layers:
+            if from_rgb is None:
+                from_rgb = self.encoder.from_rgb(rgbs[0])
+            encoded = from_rgb if is_first else (from_rgb + encoded) / 2.0
         encoded = self.encoder(encoded)
         if self.middle is not None:
             if self.enc_sa is not None:
-                encoded = self.enc_sa(encoded)
+                encoded = self.enc_sa(encoded)[0]
             middle_in = resample_signal(encoded, self.signal_freq, self.inner_freq)
-            new_rgb = resample_signal(rgb_in, self.signal_freq, self.inner_freq)
+            middle_from_rgb = None
             if is_first and alpha != 1.0:
-                middle_in = alpha * middle_in + (1.0 - alpha) * self.middle.encoder.from_rgb(new_rgb)
-            middle_out = self.middle(new_rgb, middle_in, all_rgbs, y=y, z=z if z is None else z[:, self.split_z_size:])
+                middle_from_rgb = self.middle.encoder.from_rgb(rgbs[1])
+                middle_in = alpha * middle_in + (1.0 - alpha) * middle_from_rgb
+            middle_out = self.middle(rgbs[1:], middle_in, all_rgbs, y=y, z=z if z is None else z[:, self.split_z_size:],
+                                     from_rgb=middle_from_rgb)
             inner = resample_signal(middle_out, self.inner_freq, self.signal_freq)
             decoded = torch.cat([encoded, inner], dim=1)
             if self.dec_sa is not None:
-                decoded = self.dec_sa(decoded)
+                decoded = self.dec_sa(decoded)[0]
         else:
             decoded = encoded
         decoded = self.decoder(decoded, y=y, z=z if self.split_z_size == 0 or z is None else z[:, :self.split_z_size])
-        if is_first:
+        if is_first or all_rgbs is not None:
+            rgb = self.decoder.to_rgb(decoded)
             if all_rgbs is not None:
-                all_rgbs.append(self.decoder.to_rgb(decoded))
+                all_rgbs.append(rgb)
+        if is_first:
             if self.middle is None or alpha == 1.0:
-                return self.decoder.to_rgb(decoded)
-            return self.decoder.to_rgb(decoded) * alpha + (1.0 - alpha) * self.middle.decoder.to_rgb(inner)
-        if all_rgbs is not None:
-            all_rgbs.append(self.decoder.to_rgb(decoded))
+                return rgb
+            return rgb * alpha + (1.0 - alpha) * self.middle.decoder.to_rgb(inner)
         return decoded
 
 
@@ -95,6 +121,7 @@ class Unet(nn.Module):
         if latent_size is None:
             latent_size = nf(0)
         self.input_latent_size = latent_size
+        self.num_classes = num_classes
         if num_classes != 0:
             if shared_embedding_size > 0:
                 self.y_encoder = GeneralConv(num_classes, shared_embedding_size, kernel_size=1,
@@ -116,7 +143,7 @@ class Unet(nn.Module):
                                       do=dropout, num_classes=0, act_norm=act_norm, bias=True, separable=separable)
         psunp = np.array(progression_scale_up)
         psdnp = np.array(progression_scale_down)
-        signal_lens = [0] + [initial_kernel_size * np.sum(psunp[:i] / psdnp[:i]) for i in
+        signal_lens = [0] + [initial_kernel_size * np.prod(psunp[:i] / psdnp[:i]) for i in
                              range(len(progression_scale_up) + 1)]
         for i in range(R + 1):
             inner = UnetBlock(nf(i), nf(i), ch_rgb_in, ch_rgb_out,
@@ -145,7 +172,15 @@ class Unet(nn.Module):
             z = pixel_norm(z)
         if z.ndimension() == 2:
             z = z.unsqueeze(2)
-        return self.blocks[self.depth](x, self.alpha, is_first=True, y=y, z=z)
+        return self.blocks[self.depth](self.input_pyramid(x), None, None, self.alpha, is_first=True, y=y, z=z)
+
+    def input_pyramid(self, x):
+        """x resampled once for every active block that reads it (all of them with input_to_all_layers)"""
+        num_levels = self.depth + 1 if self.input_to_all_layers else (2 if self.alpha != 1.0 else 1)
+        rgbs = [x]
+        for i in range(self.depth, self.depth + 1 - min(num_levels, self.depth + 1), -1):
+            rgbs.append(resample_signal(rgbs[-1], self.blocks[i].signal_freq, self.blocks[i].inner_freq))
+        return rgbs + [None] * (self.depth + 1 - len(rgbs))
 
 
 class GBlock(nn.Module):
@@ -201,18 +236,21 @@ class GBlock(nn.Module):
 
     @staticmethod
     def get_per_channel_noise(noise_weight, batch_size):
-        return None if noise_weight is None else torch.randn(batch_size, *noise_weight.size()[1:]) * noise_weight
+        return None if noise_weight is None else device_randn((batch_size, *noise_weight.size()[1:]),
+                                                               noise_weight) * noise_weight
 
-    def apply_conv(self, x, y, z, index):
+    def apply_conv(self, x, y, z, index, embeds):
         noise_weight = self.noises[index] if self.noises is not None else None
-        return self.convs[index](x, y=y, z=z, conv_noise=self.get_per_channel_noise(noise_weight, x.size(0)))
+        return self.convs[index](x, y=y, z=z, conv_noise=self.get_per_channel_noise(noise_weight, x.size(0)),
+                                 embed=None if embeds is None else embeds[index])
 
-    def forward(self, x, y=None, z=None, last=False):
-        h = self.apply_conv(x, y, z, 0)
-        h = self.apply_conv(h, y, z, 1)
+    def forward(self, x, y=None, z=None, last=False, embeds=None):
+        """embeds are the precomputed conditional batch norm embeddings of the convs (see Generator.embeddings)"""
+        h = self.apply_conv(x, y, z, 0, embeds)
+        h = self.apply_conv(h, y, z, 1, embeds)
         if self.deep:
-            h = self.apply_conv(h, y, z, 2)
-            h = self.apply_conv(h, y, z, 3)
+            h = self.apply_conv(h, y, z, 2, embeds)
+            h = self.apply_conv(h, y, z, 3, embeds)
             h = self.residual(h, x)
         elif self.residual is not None:
             h = h + self.residual(x)
@@ -227,7 +265,7 @@ class Generator(nn.Module):
                  equalized, init, act_alpha, num_classes, deep, z_distribution, spectral=False,
                  latent_size=256, no_tanh=False, per_channel_noise=False, to_rgb_mode='pggan', z_to_bn=False,
                  split_z=False, dropout=0.2, act_norm='pixel', conv_only=False, shared_embedding_size=32,
-                 normalize_latents=True, rgb_generation_mode='pggan'):
+                 normalize_latents=True, rgb_generation_mode='pggan', fused=False, checkpoint_depths=()):
         """
         :param initial_kernel_size: int, this should be always correct regardless of conv_only
         :param num_rgb_channels: int
@@ -259,6 +297,8 @@ class Generator(nn.Module):
         :param shared_embedding_size: int, in case it's none zero, y will be transformed to (batch_size, shared_embedding_size, T_y)
         :param normalize_latents: bool
         :param rgb_generation_mode: 'residual'sum([rgbs]) or 'mean'mean([rgbs]) or 'pggan'(last_rgb)
+        :param fused: bool, run the activation, pixel norm and dropout of each conv as one compiled kernel
+        :param checkpoint_depths: list[int], the depths whose blocks recompute their activations in the backward pass
         """
         super().__init__()
         R = len(progression_scale_up)
@@ -282,6 +322,7 @@ class Generator(nn.Module):
         if latent_size is None:
             latent_size = nf(0)
         self.input_latent_size = latent_size
+        self.num_classes = num_classes
         if num_classes != 0:
             if shared_embedding_size > 0:
                 self.y_encoder = GeneralConv(num_classes, shared_embedding_size, kernel_size=1,
@@ -298,7 +339,7 @@ class Generator(nn.Module):
                               no_tanh=no_tanh, per_channel_noise=per_channel_noise, to_rgb_mode=to_rgb_mode)
         layer_settings = dict(z_to_bn_size=latent_size if z_to_bn else 0, equalized=equalized, spectral=spectral,
                               init=init, act_alpha=act_alpha, do=dropout, num_classes=num_classes, act_norm=act_norm,
-                              bias=True, separable=separable)
+                              bias=True, separable=separable, fused=fused)
         self.block0 = GBlock(latent_size, nf(1), **block_settings, **layer_settings,
                              initial_kernel_size=None if conv_only else initial_kernel_size)
         dummy = []  # to make SA layers registered
@@ -313,6 +354,13 @@ class Generator(nn.Module):
         self.max_depth = len(self.blocks)
         self.deep = deep
         self.rgb_generation_mode = rgb_generation_mode
+        self.checkpoint_depths = set(checkpoint_depths)
+
+    def _depth_modules(self, depth):
+        return [self.blocks[depth - 1]] + ([self.self_attention[depth - 2]] if depth - 2 in self.self_attention else [])
+
+    def depth_parameters(self, depth):
+        return progressive_parameters(self, depth, self._depth_modules)
 
     def _split_z(self, l, z):
         if not self.z_to_bn:
@@ -321,13 +369,34 @@ class Generator(nn.Module):
             return z[:, (2 + l) * self.latent_size:(3 + l) * self.latent_size]
         return z
 
-    def _do_layer(self, l, h, y, z):
+    def _do_layer(self, l, h, y, z, embeds):
         if l in self.self_attention:
             h, attention_map = self.self_attention[l](h)
         else:
             attention_map = None
         h = resample_signal(h, self.progression_scale_down[l], self.progression_scale_up[l])
-        return self.blocks[l](h, y, self._split_z(l, z), last=False), attention_map
+        return run_block(self.blocks[l], l + 1 in self.checkpoint_depths, h, y, self._split_z(l, z), last=False,
+                         embeds=embeds[l + 1]), attention_map
+
+    def embeddings(self, y, z):
+        """
+        the conditional batch norm embeddings of every conv in the active blocks (block0 first), computed together
+        instead of in each conv, or Nones when there is no conditional batch norm
+        """
+        blocks = [self.block0] + list(self.blocks[:self.depth])
+        norms = [conv.norm for block in blocks for conv in block.convs]
+        if any(norm is None or norm.mode == 'BN' for norm in norms):
+            return [None] * len(blocks)
+        conds = []
+        for l, block in enumerate(blocks):
+            block_z = self._split_z(l - 1, z)
+            if l > 0 and block_z is z:  # z is not split, every block has the same condition
+                cond = conds[0]
+            else:
+                cond = block.convs[0].norm.condition(y, block_z)
+            conds.extend([cond] * len(block.convs))
+        embeds = iter(batched_embeddings(norms, conds))
+        return [[next(embeds) for _ in block.convs] for block in blocks]
 
     def _combine_rgbs(self, last_rgb, saved_rgbs):
         if self.rgb_generation_mode == 'pggan':
@@ -348,10 +417,43 @@ class Generator(nn.Module):
         else:
             raise ValueError('invalid rgb_generation_mode: {}'.format(self.rgb_generation_mode))
 
+    def receptive_field(self, depth=None):
+        """
+        (halo, ratio) of a conv_only generator at depth: every output sample depends on at most halo latent steps on
+        each side of its own and there are ratio output samples per latent step. it's worked out from the kernels and
+        the resamplings of the blocks (linear upsampling reaches one sample and the average pooling half of down / up).
+        it's None when the output can't be generated window by window: with self attention (which sees the whole
+        signal) or when a block has a fractional number of samples per latent step (the windows wouldn't align)
+        """
+        depth = self.depth if depth is None else depth
+        if any(layer < depth - 1 for layer in self.self_attention):
+            return None
+
+        def reach(module):
+            return sum(max(m.padding[0], m.kernel_size[0] - 1 - m.padding[0]) * m.dilation[0]
+                       for m in module.modules() if isinstance(m, nn.Conv1d))
+
+        ratio = Fraction(1)
+        halo = Fraction(2 if self.z_to_bn else 0)  # the batch norm embeddings are resampled from the latent steps
+        blocks = [self.block0] + list(self.blocks[:depth])
+        for i, block in enumerate(blocks):
+            if i > 0:
+                up, down = self.progression_scale_up[i - 1], self.progression_scale_down[i - 1]
+                halo += (1 + Fraction(down, 2 * up)) / ratio
+                ratio *= Fraction(up, down)
+                if ratio.denominator != 1:
+                    return None
+            halo += reach(block.convs) / ratio
+        halo += reach(blocks[-1].to_rgb) / ratio
+        return math.ceil(halo), int(ratio)
+
     def _wrap_output(self, last_rgb, all_rgbs, y):
         return {'x': self._combine_rgbs(last_rgb, all_rgbs), 'y': y}
 
     def forward(self, z, y=None):
+        if isinstance(z, dict):
+            y = z.get('y', y)
+            z = z['z']
         if y is not None:
             if y.ndimension() == 2:
                 y = y.unsqueeze(2)
@@ -371,23 +473,26 @@ class Generator(nn.Module):
             h = z
         save_rgb = self.rgb_generation_mode != 'pggan'
         saved_rgbs = []
+        embeds = self.embeddings(y, z)
         if self.depth == 0:
-            h = self.block0(h, y, self._split_z(-1, z), last=True)
+            h = run_block(self.block0, 0 in self.checkpoint_depths, h, y, self._split_z(-1, z), last=True,
+                          embeds=embeds[0])
             if save_rgb:
                 saved_rgbs.append(h)
             return self._wrap_output(h, saved_rgbs, y), {}
-        h = self.block0(h, y, self._split_z(-1, z))
+        h = run_block(self.block0, 0 in self.checkpoint_depths, h, y, self._split_z(-1, z), embeds=embeds[0])
         if save_rgb:
             saved_rgbs.append(self.block0.to_rgb(h))
         all_attention_maps = {}
         for i in range(self.depth - 1):
-            h, attention_map = self._do_layer(i, h, y, z)
+            h, attention_map = self._do_layer(i, h, y, z, embeds)
             if save_rgb:
                 saved_rgbs.append(self.blocks[i].to_rgb(h))
             if attention_map is not None:
                 all_attention_maps[i] = attention_map
         h = resample_signal(h, self.progression_scale_down[self.depth - 1], self.progression_scale_up[self.depth - 1])
-        ult = self.blocks[self.depth - 1](h, y, self._split_z(self.depth - 1, z), True)
+        ult = run_block(self.blocks[self.depth - 1], self.depth in self.checkpoint_depths, h, y,
+                        self._split_z(self.depth - 1, z), True, embeds[self.depth])
         if save_rgb:
             saved_rgbs.append(ult)
         if self.alpha == 1.0:
@@ -454,7 +559,7 @@ class Discriminator(nn.Module):
                  self_attention_layers, progression_scale_up, progression_scale_down, residual, separable,
                  equalized, init, act_alpha, num_classes, deep, spectral=False, dropout=0.2, act_norm=None,
                  group_size=4, temporal_groups_per_window=1, conv_only=False, input_to_all_layers=False,
-                 initial_sampling_rate=1.0, sinc=False):
+                 initial_sampling_rate=1.0, sinc=False, fused=False, checkpoint_depths=()):
         """
         NOTE we only support global conditioning(not temporal) for now
         :param initial_kernel_size:
@@ -480,6 +585,8 @@ class Discriminator(nn.Module):
         :param temporal_groups_per_window:
         :param conv_only:
         :param input_to_all_layers:
+        :param fused:
+        :param checkpoint_depths:
         """
         super().__init__()
         R = len(progression_scale_up)
@@ -489,12 +596,13 @@ class Discriminator(nn.Module):
         self.depth = 0
         self.alpha = 1.0
         self.input_to_all_layers = input_to_all_layers
+        self.checkpoint_depths = set(checkpoint_depths)
 
         def nf(stage):
             return min(max(int(fmap_base / (2.0 ** stage)), fmap_min), fmap_max)
 
         layer_settings = dict(equalized=equalized, spectral=spectral, init=init, act_alpha=act_alpha,
-                              do=dropout, num_classes=0, act_norm=act_norm, bias=True, separable=separable)
+                              do=dropout, num_classes=0, act_norm=act_norm, bias=True, separable=separable, fused=fused)
         block_settings = dict(ch_rgb=num_rgb_channels, k_size=kernel_size, is_residual=residual, conv_disc=conv_only,
                               group_size=group_size, temporal_groups_per_window=temporal_groups_per_window, deep=deep,
                               sinc=sinc)
@@ -525,8 +633,18 @@ class Discriminator(nn.Module):
                                   spectral=spectral, init=init)
         self.max_depth = len(self.blocks) - 1
 
+    def _depth_modules(self, depth):
+        return [self.blocks[-(depth + 1)]] + (
+            [self.self_attention[depth - 2]] if depth - 2 in self.self_attention else [])
+
+    def depth_parameters(self, depth):
+        return progressive_parameters(self, depth, self._depth_modules)
+
     def forward(self, x, y=None):
-        h = self.blocks[-(self.depth + 1)](x, True)
+        if isinstance(x, dict):
+            y = x.get('y', y)
+            x = x['x']
+        h = run_block(self.blocks[-(self.depth + 1)], self.depth in self.checkpoint_depths, x, True)
         if self.depth > 0:
             h = resample_signal(h, self.progression_scale_up[self.depth - 1],
                                 self.progression_scale_down[self.depth - 1])
@@ -540,7 +658,7 @@ class Discriminator(nn.Module):
                     h = h * self.alpha + (1.0 - self.alpha) * preult_rgb
         all_attention_maps = {}
         for i in range(self.depth, 0, -1):
-            h = self.blocks[-i](h)
+            h = run_block(self.blocks[-i], i - 1 in self.checkpoint_depths, h)
             if i > 1:
                 h = resample_signal(h, self.progression_scale_up[i - 2], self.progression_scale_down[i - 2])
                 if self.input_to_all_layers:
@@ -566,8 +684,13 @@ class MultiDiscriminator(nn.Module):
                  equalized, init, act_alpha, num_classes, deep, spectral=False, dropout=0.2, act_norm=None,
                  group_size=4, temporal_groups_per_window=1, conv_only=False, input_to_all_layers=False,
                  all_sinc_weight=0.0, all_time_weight=1.0, shared_sinc_weight=1.0, shared_time_weight=1.0,
-                 one_sec_weight=1.0, initial_sampling_rate=1.0):
+                 one_sec_weight=1.0, initial_sampling_rate=1.0, fused=False, concurrent=True, checkpoint_depths=()):
+        """
+        :param concurrent: bool, run the sub discriminators on separate cuda streams
+        :param checkpoint_depths: list[int], passed to every sub discriminator
+        """
         super().__init__()
+        self.concurrent = concurrent
         self.all_sinc_weight = all_sinc_weight
         self.all_time_weight = all_time_weight
         self.shared_sinc_weight = shared_sinc_weight
@@ -580,15 +703,16 @@ class MultiDiscriminator(nn.Module):
         self._alpha = 1.0
         self._depth = 0
         if all_sinc_weight != 0:
-            self.all_sinc_net = Discriminator(*all_params, True)
+            self.all_sinc_net = Discriminator(*all_params, True, fused=fused, checkpoint_depths=checkpoint_depths)
         if all_time_weight != 0:
-            self.all_time_net = Discriminator(*all_params, False)
+            self.all_time_net = Discriminator(*all_params, False, fused=fused, checkpoint_depths=checkpoint_depths)
         shared_params = [1, fmap_base // 2, fmap_max // 2, fmap_min // 2, kernel_size,
                          self_attention_layers, progression_scale_up, progression_scale_down, residual, separable,
                          equalized, init, act_alpha, num_classes, deep, spectral, dropout, act_norm]
         shared_k_params = dict(group_size=group_size, temporal_groups_per_window=temporal_groups_per_window,
                                conv_only=conv_only, input_to_all_layers=input_to_all_layers,
-                               initial_sampling_rate=initial_sampling_rate)
+                               initial_sampling_rate=initial_sampling_rate, fused=fused,
+                               checkpoint_depths=checkpoint_depths)
         if shared_sinc_weight != 0:
             self.shared_sinc_net = Discriminator(initial_kernel_size, *shared_params, **shared_k_params, sinc=True)
         if shared_time_weight != 0:
@@ -599,7 +723,8 @@ class MultiDiscriminator(nn.Module):
             self.one_sec_net = Discriminator(1, num_rgb_channels, *shared_params[1:], group_size=-1,
                                              temporal_groups_per_window=0, conv_only=conv_only,
                                              input_to_all_layers=input_to_all_layers,
-                                             initial_sampling_rate=initial_sampling_rate, sinc=False)
+                                             initial_sampling_rate=initial_sampling_rate, sinc=False, fused=fused,
+                                             checkpoint_depths=checkpoint_depths)
 
     @property
     def alpha(self):
@@ -625,47 +750,90 @@ class MultiDiscriminator(nn.Module):
 
     @depth.setter
     def depth(self, depth):
-        self._alpha = depth
+        self._depth = depth
         if self.all_sinc_weight != 0:
-            self.all_sinc_net.alpha = depth
+            self.all_sinc_net.depth = depth
         if self.all_time_weight != 0:
-            self.all_time_net.alpha = depth
+            self.all_time_net.depth = depth
         if self.shared_time_weight != 0:
-            self.shared_time_net.alpha = depth
+            self.shared_time_net.depth = depth
         if self.shared_sinc_weight != 0:
-            self.shared_sinc_net.alpha = depth
+            self.shared_sinc_net.depth = depth
         if self.one_sec_weight != 0:
-            self.one_sec_net.alpha = depth
+            self.one_sec_net.depth = depth
 
-    def forward(self, x, y=None):
-        o = 0.0
+    def depth_parameters(self, depth):
+        return [p for net in self.children() for p in net.depth_parameters(depth)]
+
+    def branches(self, x, y=None):
+        """(weight, function) of every sub discriminator, the functions return their (B,) part of the output"""
+        B, C, T = x.size()
+        branches = []
         if self.all_sinc_weight != 0:
-            o = o + self.all_sinc_weight * self.all_sinc_net(x, y)[0]
+            branches.append((self.all_sinc_weight, lambda: self.all_sinc_net(x, y)[0]))
         if self.all_time_weight != 0:
-            o = o + self.all_time_weight * self.all_time_net(x, y)[0]
+            branches.append((self.all_time_weight, lambda: self.all_time_net(x, y)[0]))
+
+        def shared(net):  # every channel is a separate signal
+            tmp = net(x.view(-1, 1, T), torch.repeat_interleave(y, C, 0) if y is not None else None)[0]
+            return tmp.view(B, -1).mean(dim=1)
+
         if self.shared_sinc_weight != 0:
-            tmp = self.shared_sinc_net(x.view(-1, 1, x.size(2)),
-                                       torch.repeat_interleave(y, x.size(1), 0) if y is not None else None)[0]
-            o = o + self.shared_sinc_weight * tmp.view(x.size(0), -1).mean(dim=1)
+            branches.append((self.shared_sinc_weight, lambda: shared(self.shared_sinc_net)))
         if self.shared_time_weight != 0:
-            tmp = self.shared_time_net(x.view(-1, 1, x.size(2)),
-                                       torch.repeat_interleave(y, x.size(1), 0) if y is not None else None)[0]
-            o = o + self.shared_time_weight * tmp.view(x.size(0), -1).mean(dim=1)
-        if self.one_sec_weight != 0:
+            branches.append((self.shared_time_weight, lambda: shared(self.shared_time_net)))
+
+        def one_sec():  # every window is a separate signal, the windows are stacked window major
             stride = self.signal_lens[self.depth]
-            B, _, T = x.size()
-            x = torch.cat([x[:, :, i * stride:(i + 1) * stride] for i in range(T // stride)], dim=0)
+            n = T // stride
+            windows = x.unfold(2, stride, stride).permute(2, 0, 1, 3).reshape(n * B, C, stride)
+            window_y = None
             if y is not None:
-                if y.dim() == 2:
-                    y = y.repeat(T // stride, 1)
-                else:
-                    y = y.repeat(T // stride, 1, 1)
-            r = self.one_sec_weight * self.one_sec_net(x, y)[0]
-            r = torch.stack([r[i * B:(i + 1) * B] for i in range(r.size(0) // B)]).mean(dim=0)
-            o = o + r
+                window_y = y.repeat(n, 1) if y.dim() == 2 else y.repeat(n, 1, 1)
+            r = self.one_sec_net(windows, window_y)[0]
+            return r.view(n, B, *r.size()[1:]).mean(dim=0)
+
+        if self.one_sec_weight != 0:
+            branches.append((self.one_sec_weight, one_sec))
+        return branches
+
+    def forward(self, x, y=None):
+        branches = self.branches(x, y)
+        if self.concurrent and x.is_cuda and len(branches) > 1:
+            outputs = run_concurrently([fn for _, fn in branches], x.device, (x, y))
+        else:
+            outputs = [fn() for _, fn in branches]
+        o = 0.0
+        for (weight, _), out in zip(branches, outputs):
+            o = o + weight * out
         return o
 
 
+_concurrent_streams = {}
+
+
+def run_concurrently(functions, device, inputs=()):
+    """runs every function on its own cuda stream, so their kernels can overlap, and returns their outputs"""
+    current = torch.cuda.current_stream(device)
+    streams = []
+    outputs = []
+    for i, fn in enumerate(functions):
+        if (device, i) not in _concurrent_streams:
+            _concurrent_streams[(device, i)] = torch.cuda.Stream(device)
+        stream = _concurrent_streams[(device, i)]
+        stream.wait_stream(current)
+        for t in inputs:  # they were allocated on the current stream
+            if t is not None:
+                t.record_stream(stream)
+        with torch.cuda.stream(stream):
+            outputs.append(fn())
+        streams.append(stream)
+    for stream, out in zip(streams, outputs):
+        current.wait_stream(stream)
+        out.record_stream(current)
+    return outputs
+
+
 def test_gblock():
     ch_in = 64
     ch_out = 32
@@ -938,11 +1106,125 @@ def test_unetblock():
         y = None if num_classes == 0 else torch.randn(5, num_classes)
         z = torch.randn(5, 10) if z_to_bn else None
         for a in [0.01, 0.5, 1.0]:
-            res = net(x, None, [], alpha=a, is_first=True, y=y, z=z)
+            res = net([x], None, [], alpha=a, is_first=True, y=y, z=z)
             assert res.size() == (5, ch_rgb_out, x.size(2)), res.size()
 
 
+def test_unet_input_pyramid():
+    net = Unet(3, 3, 16, False, True, False, 'kaiming_normal', 0.2, 0.0, 0, 'pixel', False, [2, 3], [1, 2], 'normal',
+               True, 32, 4, 16, 0, [1], initial_kernel_size=8)
+    for input_to_all_layers in [False, True]:
+        net.input_to_all_layers = input_to_all_layers
+        for block in net.blocks:
+            block.input_to_all_layers = input_to_all_layers
+        for depth in range(net.max_depth):
+            for alpha in [0.5, 1.0]:
+                net.depth, net.alpha = depth, alpha
+                x = torch.randn(2, 3, int(net.blocks[depth].signal_freq))
+                rgbs = net.input_pyramid(x)
+                assert len(rgbs) == depth + 1
+                for block, rgb in zip(net.blocks[depth::-1], rgbs):
+                    assert rgb is None or rgb.size(2) == int(block.signal_freq)
+                assert net(x, None, torch.randn(2, 16)).size() == x.size()
+
+
+def test_depth_parameters():
+    shared = dict(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=64, fmap_min=4, kernel_size=3,
+                  self_attention_layers=[1], progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3],
+                  residual=False, separable=False, equalized=True, init='kaiming_normal', act_alpha=0.2,
+                  num_classes=0, deep=False)
+    g = Generator(**shared, z_distribution='normal', latent_size=16)
+    d = Discriminator(**shared)
+    with torch.enable_grad():
+        for net in (g, d):
+            groups = [{id(p) for p in net.depth_parameters(i)} for i in range(net.max_depth + 1)]
+            assert sum(len(group) for group in groups) == len({id(p) for p in net.parameters()})
+            for depth in range(net.max_depth + 1):
+                for alpha in [0.5, 1.0]:
+                    net.depth = depth
+                    net.alpha = alpha
+                    net.zero_grad()
+                    if net is g:
+                        net(torch.randn(4, 16))[0]['x'].mean().backward()
+                    else:
+                        g.depth = depth
+                        net(torch.randn(4, 3, g(torch.randn(4, 16))[0]['x'].size(2)))[0].mean().backward()
+                    used = {id(p) for p in net.parameters() if p.grad is not None}
+                    assert used <= set().union(*groups[:depth + 1]), (type(net).__name__, depth, alpha)
+
+
+def test_generator_embeddings():
+    shared = dict(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  self_attention_layers=[], progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3],
+                  residual=False, separable=False, equalized=True, init='kaiming_normal', act_alpha=0.2, deep=False)
+    for num_classes, z_to_bn, split_z in [(3, False, False), (0, True, False), (3, True, False), (3, True, True)]:
+        g = Generator(**shared, num_classes=num_classes, z_distribution='normal', latent_size=20, act_norm='batch',
+                      z_to_bn=z_to_bn, split_z=split_z, spectral=True).double().eval()  # fixed spectral norms
+        g.depth = 3
+        z = torch.randn(4, 20, dtype=torch.float64)
+        y = torch.randn(4, 3, dtype=torch.float64) if num_classes else None
+        outputs = []
+        for batched in [True, False]:
+            if not batched:
+                g.embeddings = lambda y, z: [None] * (g.depth + 1)
+            set_noise_seed(0)
+            outputs.append(g(z, y)[0]['x'])
+        assert torch.allclose(outputs[0], outputs[1], atol=1e-10), (num_classes, z_to_bn, split_z)
+
+
+def test_multi_discriminator_branches():
+    shared = dict(initial_kernel_size=8, num_rgb_channels=2, fmap_base=32, fmap_max=16, fmap_min=4, kernel_size=3,
+                  self_attention_layers=[], progression_scale_up=[2, 3], progression_scale_down=[1, 2],
+                  residual=False, separable=False, equalized=True, init='kaiming_normal', act_alpha=0.2,
+                  num_classes=0, deep=False, dropout=0.0, all_sinc_weight=0.5)
+    d = MultiDiscriminator(**shared).eval()
+    d.depth = 2
+    x = torch.randn(4, 2, 8 * 2 * 3 // 2 * 3)  # 3 windows
+    expected = 0.5 * d.all_sinc_net(x)[0] + d.all_time_net(x)[0]
+    for net in [d.shared_sinc_net, d.shared_time_net]:
+        expected = expected + net(x.view(-1, 1, x.size(2)))[0].view(4, -1).mean(dim=1)
+    stride = d.signal_lens[d.depth]
+    windows = torch.cat([x[:, :, i * stride:(i + 1) * stride] for i in range(x.size(2) // stride)], dim=0)
+    r = d.one_sec_net(windows)[0]
+    expected = expected + torch.stack([r[i * 4:(i + 1) * 4] for i in range(r.size(0) // 4)]).mean(dim=0)
+    assert torch.allclose(d(x), expected, atol=1e-5)
+
+
+def test_checkpoint_depths():
+    import copy
+    shared = dict(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  self_attention_layers=[], progression_scale_up=[2, 3, 4], progression_scale_down=[1, 2, 3],
+                  residual=False, separable=False, equalized=True, init='kaiming_normal', act_alpha=0.2,
+                  num_classes=0, deep=False, spectral=True)
+    for act_norm in ['pixel', 'batch']:  # spectral norms, noise and batch norms are all replayed in the recomputation
+        g = Generator(**shared, z_distribution='normal', latent_size=16, act_norm=act_norm).double()
+        d = Discriminator(**shared, act_norm=act_norm).double()
+        g.depth = d.depth = 3
+        g.alpha = d.alpha = 0.5
+        z = torch.randn(4, 16, dtype=torch.float64)
+        results = []
+        for checkpoint_depths in [set(), {0, 2, 3}]:
+            cg, cd = copy.deepcopy(g), copy.deepcopy(d)
+            cg.checkpoint_depths = cd.checkpoint_depths = checkpoint_depths
+            set_noise_seed(0)
+            with torch.enable_grad():
+                x = cg(z)[0]['x']
+                x.pow(2).mean().backward()
+                x = x.detach().requires_grad_()
+                grad, = torch.autograd.grad(cd(x)[0].pow(2).sum(), x, create_graph=True)
+                grad.pow(2).sum().backward()  # the gradient penalty
+            results.append([x, grad] + [p.grad for p in itertools.chain(cg.parameters(), cd.parameters())] +
+                           list(itertools.chain(cg.buffers(), cd.buffers())))
+        for expected, result in zip(*results):
+            assert (expected is None and result is None) or torch.allclose(expected, result, atol=1e-10), act_norm
+
+
 def main():
+    test_checkpoint_depths()
+    test_unet_input_pyramid()
+    test_multi_discriminator_branches()
+    test_generator_embeddings()
+    test_depth_parameters()
     with torch.no_grad():
         # test_gblock()
         # test_dblock()
@@ -1,11 +1,12 @@
 import gc
 import os
+import sys
 import time
+import random
 from copy import deepcopy
 from datetime import timedelta
 from glob import glob
 from scipy import linalg
-from scipy.stats import truncnorm
 
 import matplotlib
 import numpy as np
@@ -17,10 +18,16 @@ from sklearn.utils.extmath import randomized_svd
 from metrics.ndb import NDB
 from torch_utils import Plugin, LossMonitor, Logger
 from trainer import Trainer
-from utils import generate_samples, cudize, EPSILON, resample_signal
+from utils import (generate_samples, cudize, EPSILON, resample_signal, truncated_normal, get_noise_state,
+                   set_noise_state)
 from cpc.cpc_network import Network as CpcNetwork
 from cpc.cpc_train import hp as cpc_hp
 
+try:
+    import resource
+except ImportError:  # not on windows, the autotuner has no cpu memory measurement there
+    resource = None
+
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
@@ -32,14 +39,28 @@ class DepthManager(Plugin):
     tick_kimg_override = {4: 4, 5: 4, 6: 4, 7: 3, 8: 3, 9: 2, 10: 2, 11: 1}
     training_kimg_override = {1: 200, 2: 200, 3: 200, 4: 200}
     transition_kimg_override = {1: 200, 2: 200, 3: 200, 4: 200}
+    autotune_candidates = [16, 32, 64, 128, 256, 512]
 
     def __init__(self,  # everything starts from 0 or 1
                  create_dataloader_fun, create_rlg, max_depth,
                  tick_kimg_default, get_optimizer, default_lr,
                  reset_optimizer: bool = True, disable_progression=False,
                  minibatch_default=256, depth_offset=0,  # starts form 0
-                 lod_training_kimg=400, lod_transition_kimg=400):
+                 lod_training_kimg=400, lod_transition_kimg=400, minibatch_override=None, tick_kimg_override=None,
+                 training_kimg_override=None, transition_kimg_override=None, autotune_minibatch: bool = False,
+                 autotune_candidates=None, autotune_iterations: int = 3, autotune_memory_fraction: float = 0.9,
+                 autotune_host_memory_fraction: float = 0.5, autotuned_minibatch=None):
         super().__init__([(1, 'iteration')])
+        if autotune_candidates is not None:
+            self.autotune_candidates = autotune_candidates
+        if minibatch_override is not None:
+            self.minibatch_override = minibatch_override
+        if tick_kimg_override is not None:
+            self.tick_kimg_override = tick_kimg_override
+        if training_kimg_override is not None:
+            self.training_kimg_override = training_kimg_override
+        if transition_kimg_override is not None:
+            self.transition_kimg_override = transition_kimg_override
         self.reset_optimizer = reset_optimizer
         self.minibatch_default = minibatch_default
         self.tick_kimg_default = tick_kimg_default
@@ -53,6 +74,13 @@ class DepthManager(Plugin):
         self.depth_offset = depth_offset
         self.max_depth = max_depth
         self.default_lr = default_lr
+        self.autotune_minibatch = autotune_minibatch
+        self.autotune_iterations = autotune_iterations
+        self.autotune_memory_fraction = autotune_memory_fraction
+        self.autotune_host_memory_fraction = autotune_host_memory_fraction
+        # decisions of the autotuner (depth -> minibatch_size), saved in conf.yml so a resumed run won't probe again
+        self.autotuned_minibatch = {} if autotuned_minibatch is None else autotuned_minibatch
+        self.on_autotune = None
         self.alpha_map = self.pre_compute_alpha_map(self.depth_offset, max_depth, lod_training_kimg,
                                                     self.training_kimg_override, lod_transition_kimg,
                                                     self.transition_kimg_override)
@@ -96,25 +124,156 @@ class DepthManager(Plugin):
             alpha = 1.0
         return depth, alpha
 
+    def get_minibatch_size(self, depth):
+        depth = depth - self.depth_offset
+        if not self.autotune_minibatch:
+            return self.minibatch_override.get(depth, self.minibatch_default)
+        if depth not in self.autotuned_minibatch:
+            self.autotuned_minibatch[depth] = self.autotune()
+            if self.on_autotune is not None:
+                self.on_autotune()
+        return self.autotuned_minibatch[depth]
+
+    @staticmethod
+    def peak_memory():
+        """the peak memory (MB) of the gpu since the last reset, or of the whole process (it never resets) on the cpu"""
+        if torch.cuda.is_available():
+            return torch.cuda.max_memory_allocated() / 2 ** 20
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+    @staticmethod
+    def current_memory():
+        """the memory (MB) in use now, the resident set of the process on the cpu (the peak where that's unknown)"""
+        if torch.cuda.is_available():
+            return torch.cuda.memory_allocated() / 2 ** 20
+        if os.path.exists('/proc/self/statm'):
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+        return DepthManager.peak_memory()
+
+    def memory_budget(self):
+        """MB, of the gpu or of the host, None if it can't be measured"""
+        if torch.cuda.is_available():
+            total_memory = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+            return self.autotune_memory_fraction * total_memory / 2 ** 20
+        if resource is None or not hasattr(os, 'sysconf'):
+            return None
+        total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        return self.autotune_host_memory_fraction * total_memory / 2 ** 20
+
+    def training_state(self):
+        """what the probes change besides the gradients: the buffers (batch norm statistics, spectral norm vectors) and
+        the random states (the data, the latents and the noise stream of the stochastic layers)"""
+        trainer = self.trainer
+        buffers = [b.clone() for net in (trainer.generator, trainer.discriminator) for b in net.buffers()]
+        rng = (torch.get_rng_state(), torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+               np.random.get_state(), random.getstate(), get_noise_state())
+        return buffers, rng
+
+    def restore_training_state(self, state):
+        buffers, (torch_rng, cuda_rng, numpy_rng, python_rng, noise_state) = state
+        with torch.no_grad():
+            for b, saved in zip([b for net in (self.trainer.generator, self.trainer.discriminator)
+                                 for b in net.buffers()], buffers):
+                b.copy_(saved)
+        torch.set_rng_state(torch_rng)
+        if cuda_rng is not None:
+            torch.cuda.set_rng_state_all(cuda_rng)
+        np.random.set_state(numpy_rng)
+        random.setstate(python_rng)
+        set_noise_state(noise_state)
+
+    def probe(self, minibatch_size):
+        """runs a few training iterations (without updating the weights) and returns kimg/sec and peak memory(MB)"""
+        trainer = self.trainer
+        has_cuda = torch.cuda.is_available()
+        dataiter = iter(self.create_dataloader_fun(minibatch_size))
+        latents = self.create_rlg(minibatch_size)
+        if has_cuda:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        seconds = 0.0
+        for i in range(self.autotune_iterations + 1):  # the first iteration is a warm up
+            start = time.time()
+            for _ in range(trainer.d_training_repeats):
+                trainer.d_loss(trainer.discriminator, trainer.generator, cudize(next(dataiter)),
+                               cudize(next(latents))).backward()
+            trainer.g_loss(trainer.discriminator, trainer.generator, cudize(next(dataiter)),
+                           cudize(next(latents))).backward()
+            if has_cuda:
+                torch.cuda.synchronize()
+            if i != 0:
+                seconds += time.time() - start
+        trainer.discriminator.zero_grad()
+        trainer.generator.zero_grad()
+        kimg = self.autotune_iterations * trainer.d_training_repeats * minibatch_size / 1000.0
+        return kimg / max(seconds, EPSILON), self.peak_memory()
+
+    def autotune(self):
+        """
+        the fastest of autotune_candidates that fits in the memory budget, they are probed from the smallest one and
+        the probing stops before a candidate whose memory (extrapolated linearly in the minibatch size from the last
+        probe) would go over it. the training state is the same afterwards
+        """
+        budget = self.memory_budget()
+        if budget is None:
+            print('autotune: no memory measurement here, using minibatch_size {}'.format(
+                min(self.autotune_candidates)), flush=True)
+            return min(self.autotune_candidates)
+        base_memory = self.current_memory()
+        state = self.training_state()
+        best_minibatch_size, best_speed = None, 0.0
+        previous = None
+        try:
+            for minibatch_size in sorted(self.autotune_candidates):
+                if previous is not None:
+                    growth = (previous[1] - base_memory) * minibatch_size / previous[0]
+                    if base_memory + growth > budget:
+                        break
+                try:
+                    speed, memory = self.probe(minibatch_size)
+                except RuntimeError as e:  # bigger minibatches won't fit either
+                    if 'out of memory' not in str(e):
+                        raise
+                    torch.cuda.empty_cache()
+                    break
+                print('autotune depth {}: minibatch_size {} -> {:.3f} kimg/sec, {:.0f} MB'.format(
+                    self.depth, minibatch_size, speed, memory), flush=True)
+                if memory > budget:
+                    break
+                if speed > best_speed:
+                    best_minibatch_size, best_speed = minibatch_size, speed
+                previous = (minibatch_size, memory)
+        finally:
+            self.restore_training_state(state)
+        if best_minibatch_size is None:
+            best_minibatch_size = min(self.autotune_candidates)
+        return best_minibatch_size
+
     def iteration(self, is_resuming=False, *args):
         depth, alpha = self.calc_progress()
         dataset = self.trainer.dataset
+        if alpha != self.alpha:
+            self.trainer.discriminator.alpha = self.trainer.generator.alpha = dataset.alpha = alpha
+            self.alpha = alpha
         if depth != self.depth:
             self.trainer.discriminator.depth = self.trainer.generator.depth = dataset.model_depth = depth
             self.depth = depth
-            minibatch_size = self.minibatch_override.get(depth - self.depth_offset, self.minibatch_default)
-            if self.reset_optimizer and not is_resuming:
-                self.trainer.optimizer_g, self.trainer.optimizer_d, self.trainer.lr_scheduler_g, self.trainer.lr_scheduler_d = self.get_optimizer(
-                    self.minibatch_default * self.default_lr / minibatch_size)
+            minibatch_size = self.get_minibatch_size(depth)
+            lr = self.minibatch_default * self.default_lr / minibatch_size
+            optimizers = (self.trainer.optimizer_g, self.trainer.optimizer_d,
+                          self.trainer.lr_scheduler_g, self.trainer.lr_scheduler_d)
+            if self.trainer.optimizer_g is None or (self.reset_optimizer and not is_resuming):
+                optimizers = self.get_optimizer(lr, depth)
+            else:  # only add the parameters of the new blocks
+                optimizers = self.get_optimizer(lr, depth, optimizers)
+            self.trainer.optimizer_g, self.trainer.optimizer_d, self.trainer.lr_scheduler_g, self.trainer.lr_scheduler_d = optimizers
             self.data_loader = self.create_dataloader_fun(minibatch_size)
             self.trainer.dataiter = iter(self.data_loader)
             self.trainer.random_latents_generator = self.create_rlg(minibatch_size)
             tick_duration_kimg = self.tick_kimg_override.get(depth - self.depth_offset, self.tick_kimg_default)
             self.trainer.tick_duration_nimg = int(tick_duration_kimg * 1000)
             self.trainer.stats['minibatch_size'] = minibatch_size
-        if alpha != self.alpha:
-            self.trainer.discriminator.alpha = self.trainer.generator.alpha = dataset.alpha = alpha
-            self.alpha = alpha
         self.trainer.stats['depth'] = depth
         self.trainer.stats['alpha']['val'] = alpha
 
@@ -249,7 +408,7 @@ class OutputGenerator(Plugin):
 
     @staticmethod
     def truncated_z_sample(batch_size, z_dim, truncation=0.5):
-        values = truncnorm.rvs(-2, 2, size=(batch_size, z_dim))
+        values = truncated_normal(torch.rand(batch_size, z_dim), 2.0).numpy()
         return truncation * values
 
     @staticmethod
@@ -0,0 +1,99 @@
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# bigger factors fall back to the interpolate + avg_pool1d path in utils.resample_signal
+MAX_POLYPHASE_FACTOR = 512
+
+
+def rational_factors(signal_freq, desired_freq):
+    """returns (up, down) for integral (or integral valued) frequencies and None otherwise"""
+    if int(signal_freq) != signal_freq or int(desired_freq) != desired_freq:
+        return None
+    ratio = Fraction(int(desired_freq), int(signal_freq))
+    if ratio.numerator > MAX_POLYPHASE_FACTOR or ratio.denominator > MAX_POLYPHASE_FACTOR:
+        return None
+    return ratio.numerator, ratio.denominator
+
+
+def polyphase_weights(up, down):
+    """
+    linear upsampling by up (align_corners=False) followed by an average pooling of size down, as one filter bank:
+    output n = m * up + phase is weights[phase] applied to x[m * down - 1:m * down + down + 1]
+    """
+    weights = np.zeros((up, down + 2))
+    for phase in range(up):
+        for j in range(phase * down, phase * down + down):  # the upsampled samples of this output
+            k, f = j // up, (j % up + 0.5) / up - 0.5  # source index and the fractional offset from it
+            if f >= 0:
+                weights[phase, k + 1] += 1 - f
+                weights[phase, k + 2] += f
+            else:
+                weights[phase, k] += -f
+                weights[phase, k + 1] += 1 + f
+    return weights / down
+
+
+class Resampler(object):
+    def __init__(self, up, down):
+        self.up = up
+        self.down = down
+        self.weights = torch.from_numpy(polyphase_weights(up, down).T.copy())  # down + 2, up
+        self.cache = {}
+
+    def weight_like(self, x):
+        key = (x.device, x.dtype)
+        if key not in self.cache:
+            self.cache[key] = self.weights.to(device=x.device, dtype=x.dtype)
+        return self.cache[key]
+
+    def __call__(self, x):  # B, C, T
+        if self.up == 1:
+            if self.down == 1:
+                return x
+            return F.avg_pool1d(x, self.down, self.down, 0, False, True)
+        if self.down == 1:
+            return F.interpolate(x, scale_factor=self.up, mode='linear', align_corners=False)
+        B, C, T = x.size()
+        # replicating the edges is what the clamping of interpolate does, the rest of the padding only makes all
+        # the phases the same length and its outputs are dropped
+        h = F.pad(x.reshape(B * C, 1, T), (1, self.down + 1), mode='replicate').view(B * C, -1)
+        h = h.unfold(1, self.down + 2, self.down)  # B*C, T // down + 1, down + 2
+        h = torch.matmul(h, self.weight_like(x))  # B*C, T // down + 1, up
+        return h.reshape(B, C, -1)[..., :T * self.up // self.down]
+
+
+@lru_cache(maxsize=None)
+def get_resampler(up, down):
+    return Resampler(up, down)
+
+
+def test_resampler():
+    from utils import resample_signal
+
+    for up in range(1, 7):
+        for down in range(1, 7):
+            for seq_len in [2, 3, 7, 32, 61]:
+                if seq_len * up < down:
+                    continue
+                x = torch.randn(3, 4, seq_len, dtype=torch.float64, requires_grad=True)
+                expected = resample_signal(x, down, up, exact=True)
+                result = resample_signal(x, down, up)
+                assert result.size() == expected.size(), (up, down, seq_len)
+                assert torch.allclose(result, expected, atol=1e-12), (up, down, seq_len)
+                grad_expected, = torch.autograd.grad((expected ** 2).sum(), x)
+                grad_result, = torch.autograd.grad((result ** 2).sum(), x)
+                assert torch.allclose(grad_result, grad_expected, atol=1e-12), (up, down, seq_len)
+    assert rational_factors(2.5, 5) is None
+    assert rational_factors(1920, 1800) == (15, 16)
+
+
+def main():
+    test_resampler()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+import io
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import http.client
+import socketserver
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from generate import load_sampler, sample_latents
+from utils import simple_argparser, truncated_normal
+
+default_params = dict(
+    checkpoint='',  # an exported generator (export.py) or a (smooth) generator checkpoint of a training run
+    config_file='',  # for checkpoints, empty means the conf.yml next to it
+    host='127.0.0.1',
+    port=8000,
+    unix_socket='',  # serve on this unix socket instead of host:port
+    max_batch_size=64,  # samples per forward pass, the requests of all clients are coalesced up to it
+    max_latency_ms=10.0,  # the longest a request waits for others to share its batch
+    max_request_samples=4096,
+    num_threads=0,  # of torch, 0 means its default
+    log_requests=False,
+    cuda=False,
+)
+
+LATENCY_BOUNDS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class Histogram(object):
+    """counts per bucket (bounds are the inclusive upper edges, the last bucket is everything above them)"""
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, value, count=1):
+        with self.lock:
+            self.counts[bisect_left(self.bounds, value)] += count
+            self.count += count
+            self.total += value * count
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """the upper edge of the bucket of the q quantile (the max for the last bucket)"""
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        with self.lock:
+            return dict(bounds=self.bounds, counts=list(self.counts), count=self.count, max=self.max,
+                        mean=self.total / max(self.count, 1),
+                        p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+class Stats(object):
+    def __init__(self, max_batch_size):
+        self.start = time.perf_counter()
+        self.busy = 0.0
+        self.requests = 0
+        self.samples = 0
+        self.latency = Histogram(LATENCY_BOUNDS_MS)  # of whole requests, in the handler
+        self.queue = Histogram(LATENCY_BOUNDS_MS)  # from arrival to the start of the batch, per request piece
+        self.compute = Histogram(LATENCY_BOUNDS_MS)  # per batch
+        self.batch_size = Histogram([2 ** i for i in range(int(np.log2(max_batch_size)) + 1)])
+        self.lock = threading.Lock()
+
+    def add_request(self, num_samples, latency_ms):
+        with self.lock:
+            self.requests += 1
+            self.samples += num_samples
+        self.latency.add(latency_ms)
+
+    def to_dict(self):
+        uptime = time.perf_counter() - self.start
+        return dict(uptime=uptime, utilization=self.busy / uptime, requests=self.requests, samples=self.samples,
+                    latency_ms=self.latency.to_dict(), queue_ms=self.queue.to_dict(),
+                    compute_ms=self.compute.to_dict(), batch_size=self.batch_size.to_dict())
+
+
+class Piece(object):
+    """up to max_batch_size samples of a request, the unit of the micro batches"""
+
+    def __init__(self, z, labels):
+        self.z = z
+        self.labels = labels
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.samples = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    one thread runs the generator for all clients: it takes request pieces off a queue until the batch has
+    max_batch_size samples or its oldest piece waited max_latency seconds, then splits the output between them
+    """
+
+    def __init__(self, model, config, max_batch_size=64, max_latency=0.01, device='cpu'):
+        self.model = model
+        self.config = config
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.device = device
+        self.stats = Stats(max_batch_size)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, z, labels=None):
+        """blocks until the samples of z (and labels) are generated, whatever batches they end up in"""
+        pieces = [Piece(z[i:i + self.max_batch_size], None if labels is None else labels[i:i + self.max_batch_size])
+                  for i in range(0, z.size(0), self.max_batch_size)]
+        for piece in pieces:
+            self.queue.put(piece)
+        for piece in pieces:
+            piece.done.wait()
+            if piece.error is not None:
+                raise piece.error
+        return torch.cat([piece.samples for piece in pieces])
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def next_batch(self, first):
+        """the pieces of a batch that starts with first, and the piece that didn't fit into it"""
+        batch, size = [first], first.z.size(0)
+        deadline = first.arrival + self.max_latency
+        while size < self.max_batch_size:
+            try:
+                piece = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if piece is None or size + piece.z.size(0) > self.max_batch_size:
+                return batch, piece
+            batch.append(piece)
+            size += piece.z.size(0)
+        return batch, False
+
+    def run(self):
+        leftover = False
+        while True:
+            first = self.queue.get() if leftover is False else leftover
+            if first is None:
+                return
+            batch, leftover = self.next_batch(first)
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        start = time.perf_counter()
+        for piece in batch:
+            self.stats.queue.add(1000 * (start - piece.arrival))
+        try:
+            z = torch.cat([piece.z for piece in batch]).to(self.device)
+            inputs = (z,)
+            if self.config['num_classes']:
+                labels = torch.cat([piece.labels for piece in batch]).to(self.device)
+                inputs = (z, F.one_hot(labels, self.config['num_classes']).to(z))
+            with torch.no_grad():
+                samples = self.model(*inputs).cpu()
+            for piece, s in zip(batch, samples.split([piece.z.size(0) for piece in batch])):
+                piece.samples = s
+        except Exception as e:
+            for piece in batch:
+                piece.error = e
+        elapsed = time.perf_counter() - start
+        self.stats.busy += elapsed
+        self.stats.compute.add(1000 * elapsed)
+        self.stats.batch_size.add(sum(piece.z.size(0) for piece in batch))
+        for piece in batch:
+            piece.done.set()
+
+
+def request_latents(config, num_samples, seed, truncation=0.0, labels=None):
+    """
+    z (and class labels) of a request, only a function of its settings, so the same seed gives the same samples in
+    any micro batch (unless the generator has per channel noise). labels is None (random ones), a class or a class
+    per sample
+    """
+    rng = torch.Generator().manual_seed(seed)
+    if truncation > 0:
+        if config['z_distribution'] != 'normal':
+            raise ValueError('truncation needs a normal z_distribution')
+        size = (num_samples, config['latent_size']) + ((config['initial_kernel_size'],) if config['conv_only'] else ())
+        z = truncated_normal(torch.rand(size, generator=rng), truncation)
+        random_labels = None
+        if config['num_classes']:
+            random_labels = torch.randint(config['num_classes'], (num_samples,), generator=rng)
+    else:
+        z, random_labels = sample_latents(config, num_samples, rng)
+    if labels is None:
+        return z, random_labels
+    if not config['num_classes']:
+        raise ValueError('the generator is not conditional')
+    if not isinstance(labels, list):
+        labels = [labels] * num_samples
+    if len(labels) != num_samples or not all(isinstance(c, int) and not isinstance(c, bool) for c in labels):
+        raise ValueError('labels should be a class or a list of num_samples classes')
+    labels = torch.tensor(labels, dtype=torch.long)
+    if labels.min() < 0 or labels.max() >= config['num_classes']:
+        raise ValueError('labels should be in [0, {})'.format(config['num_classes']))
+    return z, labels
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET /health, GET /stats (latency and batch size histograms) and POST /generate with a json body of num_samples,
+    seed (a random one by default), truncation (0 means none), labels and format (json or npy)
+    """
+    server_version = 'pggan-serve'
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def log_message(self, *args):
+        if self.server.params['log_requests']:
+            super().log_message(*args)
+
+    def reply(self, code, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.reply(200, dict(status='ok', config=self.server.batcher.config))
+        elif self.path == '/stats':
+            self.reply(200, self.server.batcher.stats.to_dict())
+        else:
+            self.reply(404, dict(error='unknown path ' + self.path))
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self.reply(404, dict(error='unknown path ' + self.path))
+        start = time.perf_counter()
+        batcher, params = self.server.batcher, self.server.params
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError('the request should be a json object')
+            num_samples = int(request.get('num_samples', 1))
+            if not 0 < num_samples <= params['max_request_samples']:
+                raise ValueError('num_samples should be in [1, {}]'.format(params['max_request_samples']))
+            seed = int(request['seed']) if request.get('seed') is not None else int.from_bytes(os.urandom(7), 'big')
+            output_format = request.get('format', 'json')
+            if output_format not in ('json', 'npy'):
+                raise ValueError('format should be json or npy')
+            z, labels = request_latents(batcher.config, num_samples, seed, float(request.get('truncation', 0.0)),
+                                        request.get('labels'))
+        except (ValueError, TypeError, KeyError) as e:
+            return self.reply(400, dict(error=str(e)))
+        try:
+            samples = batcher.submit(z, labels).numpy()
+        except Exception as e:  # of the whole batch, raised in every request of it
+            return self.reply(500, dict(error='generation failed: {}'.format(e)))
+        labels = None if labels is None else labels.tolist()
+        if output_format == 'npy':
+            buffer = io.BytesIO()
+            np.save(buffer, samples)
+            self.reply(200, buffer.getvalue(), 'application/octet-stream',
+                       {'X-Seed': str(seed), 'X-Labels': json.dumps(labels)})
+        else:
+            self.reply(200, dict(seed=seed, labels=labels, shape=samples.shape, samples=samples.tolist()))
+        batcher.stats.add_request(num_samples, 1000 * (time.perf_counter() - start))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """an http.client connection to a unix socket server, for clients"""
+
+    def __init__(self, path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def create_server(batcher, params):
+    if params['unix_socket']:
+        if os.path.exists(params['unix_socket']):
+            os.remove(params['unix_socket'])
+        server = UnixHTTPServer(params['unix_socket'], Handler)
+    else:
+        server = ThreadingHTTPServer((params['host'], params['port']), Handler)
+        server.daemon_threads = True
+    server.batcher = batcher
+    server.params = params
+    return server
+
+
+def test_serve():
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.error import HTTPError
+    from urllib.request import urlopen, Request
+
+    from export import freeze_generator, export_config
+    from network import Generator
+
+    g = Generator(initial_kernel_size=8, num_rgb_channels=3, fmap_base=64, fmap_max=32, fmap_min=4, kernel_size=3,
+                  progression_scale_up=[2, 3], progression_scale_down=[1, 2], residual=False,
+                  init='kaiming_normal', act_alpha=0.2, deep=False, z_distribution='normal', latent_size=16,
+                  self_attention_layers=[], separable=False, equalized=True, spectral=False, act_norm='batch',
+                  num_classes=3)
+    g.depth = g.max_depth
+    with torch.no_grad():
+        g(torch.randn(16, 16), torch.randn(16, 3))
+    model = freeze_generator(g)
+    config = export_config(model)
+    batcher = MicroBatcher(model, config, max_batch_size=8, max_latency=0.2)
+    params = dict(default_params, port=0)
+    server = create_server(batcher, params)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    def post(payload):
+        with urlopen(Request(url + '/generate', json.dumps(payload).encode(), method='POST')) as response:
+            return json.loads(response.read())
+
+    requests = [dict(num_samples=n, seed=i, truncation=[0, 1.0][i % 2], labels=[None, 2][i % 2])
+                for i, n in enumerate([1, 3, 2, 5, 1, 1, 2, 4])]
+    with ThreadPoolExecutor(len(requests)) as pool:
+        results = list(pool.map(post, requests))
+    for request, result in zip(requests, results):
+        z, labels = request_latents(config, request['num_samples'], request['seed'], request['truncation'],
+                                    request['labels'])
+        with torch.no_grad():
+            expected = model(z, F.one_hot(labels, 3).float())
+        assert result['labels'] == labels.tolist() and result['shape'] == list(expected.shape)
+        assert np.allclose(result['samples'], expected.numpy(), atol=1e-5)
+    with urlopen(url + '/stats') as response:
+        stats = json.loads(response.read())
+    assert stats['requests'] == len(requests) and stats['samples'] == 19
+    assert stats['batch_size']['count'] < len(requests) and stats['batch_size']['max'] <= 8  # coalesced
+    for bad in [dict(labels=3), dict(num_samples=2, labels=[1]), dict(labels=[[1]]), dict(labels='1'), [], 3, 'x']:
+        try:
+            post(bad)
+            assert False, bad
+        except HTTPError as e:
+            assert e.code == 400, bad
+    server.shutdown()
+    server.server_close()
+
+    def broken(*inputs):
+        raise RuntimeError('broken generator')
+
+    broken_batcher = MicroBatcher(broken, config, max_batch_size=8, max_latency=0.01)
+    server = create_server(broken_batcher, dict(default_params, port=0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    for _ in range(2):  # the server keeps answering
+        try:
+            post(dict(num_samples=2))
+            assert False
+        except HTTPError as e:
+            assert e.code == 500 and 'broken generator' in json.loads(e.read())['error']
+    server.shutdown()
+    server.server_close()
+    broken_batcher.stop()
+    with tempfile.TemporaryDirectory() as directory:
+        params = dict(default_params, unix_socket=os.path.join(directory, 'generator.sock'))
+        server = create_server(batcher, params)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        connection = UnixHTTPConnection(params['unix_socket'])
+        connection.request('POST', '/generate', json.dumps(dict(num_samples=2, seed=7, format='npy')))
+        response = connection.getresponse()
+        samples = np.load(io.BytesIO(response.read()))
+        assert response.status == 200 and samples.shape[0] == 2 and response.getheader('X-Seed') == '7'
+        connection.close()
+        server.shutdown()
+        server.server_close()
+    batcher.stop()
+
+
+def main(params):
+    if params['num_threads']:
+        torch.set_num_threads(params['num_threads'])
+    device = 'cuda' if params['cuda'] and torch.cuda.is_available() else 'cpu'
+    model, config = load_sampler(params['checkpoint'], params['config_file'], device)
+    batcher = MicroBatcher(model, config, params['max_batch_size'], params['max_latency_ms'] / 1000, device)
+    with torch.no_grad():  # warm up (the first TorchScript calls are profiling runs)
+        for _ in range(2):
+            batcher.submit(*request_latents(config, params['max_batch_size'], 0))
+    batcher.stats = Stats(params['max_batch_size'])
+    server = create_server(batcher, params)
+    print('serving {} on {}'.format(params['checkpoint'], params['unix_socket'] or
+                                    'http://{}:{}'.format(*server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.stop()
+
+
+if __name__ == '__main__':
+    main(simple_argparser(default_params))
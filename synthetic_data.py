@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+from tqdm import trange
+from scipy.io import savemat
+
+from utils import mkdir, simple_argparser
+
+default_params = dict(
+    dir_path='./data/synthetic_eegs/',
+    num_files=8,
+    num_channels=17,
+    duration=600.0,  # seconds per file
+    sampling_freq=220,
+    file_format='mat',  # mat or txt
+    random_seed=1373,
+)
+
+# (low, high) in hz and the relative amplitude of each band
+EEG_BANDS = [(0.5, 4.0, 1.0), (4.0, 8.0, 0.6), (8.0, 13.0, 0.8), (13.0, 30.0, 0.3), (30.0, 45.0, 0.1)]
+
+
+def pink_noise(num_channels, length, rng):
+    spectrum = rng.standard_normal((num_channels, length // 2 + 1)) + \
+               1j * rng.standard_normal((num_channels, length // 2 + 1))
+    scale = np.zeros(length // 2 + 1)
+    scale[1:] = 1.0 / np.sqrt(np.arange(1, length // 2 + 1))
+    noise = np.fft.irfft(spectrum * scale, n=length, axis=1)
+    return noise / (noise.std(axis=1, keepdims=True) + 1e-8)
+
+
+def mixed_sinusoids(num_channels, length, sampling_freq, rng, components_per_band=3):
+    t = np.arange(length) / sampling_freq
+    signal = np.zeros((num_channels, length))
+    for low, high, amplitude in EEG_BANDS:
+        high = min(high, sampling_freq / 2.0)
+        if low >= high:
+            continue
+        freqs = rng.uniform(low, high, (num_channels, components_per_band, 1))
+        phases = rng.uniform(0, 2 * np.pi, (num_channels, components_per_band, 1))
+        amps = amplitude * rng.uniform(0.5, 1.0, (num_channels, components_per_band, 1))
+        # slow amplitude modulation, so the bands come and go like real rhythms
+        modulation = 1.0 + 0.5 * np.sin(2 * np.pi * rng.uniform(0.01, 0.1, (num_channels, 1, 1)) * t +
+                                         rng.uniform(0, 2 * np.pi, (num_channels, 1, 1)))
+        signal += (amps * modulation * np.sin(2 * np.pi * freqs * t + phases)).sum(axis=1)
+    return signal
+
+
+def add_artifacts(signal, sampling_freq, rng, events_per_minute=4.0):
+    num_channels, length = signal.shape
+    num_events = rng.poisson(events_per_minute * length / sampling_freq / 60.0)
+    for _ in range(num_events):
+        kind = rng.choice(['blink', 'muscle', 'pop'])
+        start = rng.randint(length)
+        channels = rng.choice(num_channels, rng.randint(1, max(num_channels // 3, 1) + 1), replace=False)
+        if kind == 'blink':  # large and slow bump, mostly on a few channels
+            duration = int(rng.uniform(0.2, 0.5) * sampling_freq)
+            bump = np.hanning(duration) * rng.uniform(5.0, 10.0)
+            end = min(start + duration, length)
+            signal[channels, start:end] += bump[:end - start]
+        elif kind == 'muscle':  # burst of high frequency noise
+            duration = int(rng.uniform(0.5, 2.0) * sampling_freq)
+            end = min(start + duration, length)
+            burst = rng.standard_normal((len(channels), end - start)) * rng.uniform(1.0, 3.0)
+            signal[channels, start:end] += burst * np.hanning(end - start)
+        else:  # electrode pop, a step that decays back to the baseline
+            decay = np.exp(-np.arange(length - start) / (rng.uniform(0.1, 1.0) * sampling_freq))
+            signal[channels, start:] += rng.uniform(-8.0, 8.0) * decay
+    return signal
+
+
+def synthetic_recording(num_channels, length, sampling_freq, rng):
+    signal = mixed_sinusoids(num_channels, length, sampling_freq, rng)
+    signal += 0.5 * pink_noise(num_channels, length, rng)
+    signal = add_artifacts(signal, sampling_freq, rng)
+    return (signal * 10.0).astype(np.float32)  # roughly in micro volts
+
+
+def write_corpus(dir_path, num_files=8, num_channels=17, duration=600.0, sampling_freq=220, file_format='mat',
+                 random_seed=1373):
+    """
+    writes files that EEGDataset can read, either '{name}.mat' with an 'eeg_signal' (channels, time) matrix
+    or one '{name}_{channel}.txt' (channels starting from 1) per channel
+    """
+    if file_format not in {'mat', 'txt'}:
+        raise ValueError('invalid file_format: {}'.format(file_format))
+    mkdir(dir_path)
+    rng = np.random.RandomState(random_seed)
+    length = int(duration * sampling_freq)
+    for i in trange(num_files):
+        signal = synthetic_recording(num_channels, length, sampling_freq, rng)
+        name = os.path.join(dir_path, 'synthetic{:04}'.format(i))
+        if file_format == 'mat':
+            savemat(name + '.mat', {'eeg_signal': signal})
+        else:
+            for j in range(num_channels):
+                np.savetxt('{}_{}.txt'.format(name, j + 1), signal[j], fmt='%.4f')
+    return dir_path
+
+
+if __name__ == '__main__':
+    write_corpus(**simple_argparser(default_params))
@@ -18,7 +18,7 @@ from network import Generator, Discriminator
 from plugins import (OutputGenerator, TeeLogger, AbsoluteTimeMonitor, SlicedWDistance, SaverPlugin,
                      EfficientLossMonitor, DepthManager, EvalDiscriminator, WatchSingularValues)
 from trainer import Trainer
-from utils import cudize, random_latents, trainable_params, create_result_subdir, num_params, parse_config, load_model
+from utils import cudize, random_latents, create_result_subdir, num_params, parse_config, load_model
 
 default_params = dict(
     result_dir='results',
@@ -72,6 +72,33 @@ def load_models(resume_network, result_dir, logger):
     return generator, g_optimizer, discriminator, d_optimizer, g_cur_img
 
 
+def depth_layout_state(state, network, depth_groups):
+    """
+    the saved state of an optimizer of the network in the layout of get_optimizers (one param group per depth,
+    depth_groups are their parameters), it already is unless it's from before that layout: a single group of all the
+    trainable parameters (in the order of network.parameters()), which is then split into the depth groups
+    """
+    groups = state['param_groups']
+    if len(groups) > 1 or len(groups[0]['params']) == len(depth_groups[0]):
+        return state
+    trainable = [p for p in network.parameters() if p.requires_grad]
+    if len(groups[0]['params']) != len(trainable) or sum(map(len, depth_groups)) != len(trainable):
+        raise ValueError('the optimizer state has a single param group of {} parameters, which is neither the {} '
+                         'of the first depth nor all the {} trainable parameters of the network'.format(
+                             len(groups[0]['params']), len(depth_groups[0]), len(trainable)))
+    old_ids = {id(p): i for p, i in zip(trainable, groups[0]['params'])}
+    new_state, param_groups, new_id = {}, [], 0
+    for params in depth_groups:
+        ids = []
+        for p in params:
+            if old_ids[id(p)] in state['state']:
+                new_state[new_id] = state['state'][old_ids[id(p)]]
+            ids.append(new_id)
+            new_id += 1
+        param_groups.append(dict(groups[0], params=ids))
+    return dict(state=new_state, param_groups=param_groups)
+
+
 def thread_exit(_signal, frame):
     exit(0)
 
@@ -80,9 +107,24 @@ def worker_init(x):
     signal.signal(signal.SIGINT, thread_exit)
 
 
-def main(params):
+def create_networks(params, initial_kernel_size, num_rgb_channels, progression_scale_up, progression_scale_down):
+    shared_model_params = dict(initial_kernel_size=initial_kernel_size, num_rgb_channels=num_rgb_channels,
+                               fmap_base=params['fmap_base'], fmap_max=params['fmap_max'], fmap_min=params['fmap_min'],
+                               kernel_size=params['kernel_size'], self_attention_layers=params['self_attention_layers'],
+                               progression_scale_up=progression_scale_up,
+                               progression_scale_down=progression_scale_down, residual=params['residual'],
+                               separable=params['separable'], equalized=params['equalized'], init=params['init'],
+                               act_alpha=params['act_alpha'], num_classes=params['num_classes'], deep=params['deep'])
+    generator = Generator(**shared_model_params, z_distribution=params['z_distribution'], **params['Generator'])
+    discriminator = Discriminator(**shared_model_params, **params['Discriminator'])
+    return generator, discriminator
+
+
+def main(params, extra_plugins=()):
     dataset_params = params['EEGDataset']
-    dataset, val_dataset = EEGDataset.from_config(**dataset_params)
+    # these are only saved in conf.yml for reference, the dataset takes them from its class attributes
+    dataset, val_dataset = EEGDataset.from_config(**{k: v for k, v in dataset_params.items() if k not in (
+        'progression_scale_up', 'progression_scale_down', 'picked_channels')})
     if params['config_file'] and params['exp_name'] == '':
         params['exp_name'] = params['config_file'].split('/')[-1].split('.')[0]
     result_dir = create_result_subdir(params['result_dir'], params['exp_name'])
@@ -97,13 +139,6 @@ def main(params):
         stats_to_log.extend(['swd.val', 'swd.epoch'])
 
     logger = TeeLogger(os.path.join(result_dir, 'log.txt'), params['exp_name'], stats_to_log, [(1, 'epoch')])
-    shared_model_params = dict(initial_kernel_size=dataset.initial_kernel_size, num_rgb_channels=dataset.num_channels,
-                               fmap_base=params['fmap_base'], fmap_max=params['fmap_max'], fmap_min=params['fmap_min'],
-                               kernel_size=params['kernel_size'], self_attention_layers=params['self_attention_layers'],
-                               progression_scale_up=dataset.progression_scale_up,
-                               progression_scale_down=dataset.progression_scale_down, residual=params['residual'],
-                               separable=params['separable'], equalized=params['equalized'], init=params['init'],
-                               act_alpha=params['act_alpha'], num_classes=params['num_classes'], deep=params['deep'])
     for n in ('Generator', 'Discriminator'):
         p = params[n]
         if p['spectral']:
@@ -115,8 +150,8 @@ def main(params):
         logger.log('Warning, you have set the residual to false and disabled the progression')
     if params['Discriminator']['act_norm'] is not None:
         logger.log('Warning, you are using an activation normalization in discriminator')
-    generator = Generator(**shared_model_params, z_distribution=params['z_distribution'], **params['Generator'])
-    discriminator = Discriminator(**shared_model_params, **params['Discriminator'])
+    generator, discriminator = create_networks(params, dataset.initial_kernel_size, dataset.num_channels,
+                                               dataset.progression_scale_up, dataset.progression_scale_down)
 
     def rampup(cur_nimg):
         if cur_nimg < params['lr_rampup_kimg'] * 1000:
@@ -128,12 +163,36 @@ def main(params):
     if params['ttur']:
         params['Adam']['betas'] = (0, 0.9)
 
-    def get_optimizers(g_lr):
+    def depth_group(network, depth):
+        return {'params': [p for p in network.depth_parameters(depth) if p.requires_grad]}
+
+    def get_optimizers(g_lr, depth, optimizers=None):
+        """
+        optimizers only get the parameters of the blocks used up to the given depth (one param group per depth),
+        if the current (opt_g, opt_d, lr_scheduler_g, lr_scheduler_d) are given they will grow to the new depth, with
+        all their groups at the new learning rates
+        """
         d_lr = g_lr
         if params['ttur']:
             d_lr *= 4.0
-        opt_g = Adam(trainable_params(generator), g_lr, **params['Adam'])
-        opt_d = Adam(trainable_params(discriminator), d_lr, **params['Adam'])
+        if optimizers is not None:
+            for opt, lr_scheduler, network, lr in zip(optimizers[:2], optimizers[2:], (generator, discriminator),
+                                                      (g_lr, d_lr)):
+                opt.defaults['lr'] = lr
+                for i in range(len(opt.param_groups), depth + 1):
+                    opt.add_param_group(depth_group(network, i))
+                    if lr_scheduler is not None:
+                        lr_scheduler.lr_lambdas.append(rampup)
+                for group in opt.param_groups:
+                    group['lr'] = lr
+                    if lr_scheduler is not None:
+                        group['initial_lr'] = lr
+                        group['lr'] = lr * rampup(lr_scheduler.last_epoch)
+                if lr_scheduler is not None:
+                    lr_scheduler.base_lrs = [lr] * len(opt.param_groups)
+            return optimizers
+        opt_g = Adam([depth_group(generator, i) for i in range(depth + 1)], g_lr, **params['Adam'])
+        opt_d = Adam([depth_group(discriminator, i) for i in range(depth + 1)], d_lr, **params['Adam'])
         if params['lr_rampup_kimg'] > 0:
             lr_scheduler_g = LambdaLR(opt_g, rampup, -1)
             lr_scheduler_d = LambdaLR(opt_d, rampup, -1)
@@ -146,9 +205,15 @@ def main(params):
             params['resume_network'], params['result_dir'], logger)
         generator.load_state_dict(generator_state)
         discriminator.load_state_dict(discriminator_state)
-        opt_g, opt_d, _, _ = get_optimizers(params['lr'])
-        opt_g.load_state_dict(opt_g_state)
-        opt_d.load_state_dict(opt_d_state)
+        # the saved optimizers have one param group per depth that they have seen, or (from before the groups) a
+        # single one of all the parameters, which are all the depths
+        depth = len(opt_g_state['param_groups']) - 1
+        if depth == 0 and len(opt_g_state['param_groups'][0]['params']) != len(depth_group(generator, 0)['params']):
+            depth = generator.max_depth
+        opt_g, opt_d, _, _ = get_optimizers(params['lr'], depth)
+        opt_g.load_state_dict(depth_layout_state(opt_g_state, generator, [g['params'] for g in opt_g.param_groups]))
+        opt_d.load_state_dict(depth_layout_state(opt_d_state, discriminator,
+                                                 [g['params'] for g in opt_d.param_groups]))
     else:
         opt_g = None
         opt_d = None
@@ -203,10 +268,23 @@ def main(params):
         while True:
             yield {'z': cudize(random_latents(minibatch_size, latent_size, params['z_distribution']))}
 
+    def save_config():
+        params['EEGDataset']['progression_scale_up'] = dataset.progression_scale_up
+        params['EEGDataset']['progression_scale_down'] = dataset.progression_scale_down
+        params['EEGDataset']['picked_channels'] = dataset.picked_channels
+        params['DepthManager']['minibatch_override'] = dm.minibatch_override
+        params['DepthManager']['tick_kimg_override'] = dm.tick_kimg_override
+        params['DepthManager']['training_kimg_override'] = dm.training_kimg_override
+        params['DepthManager']['transition_kimg_override'] = dm.transition_kimg_override
+        params['DepthManager']['autotune_candidates'] = dm.autotune_candidates
+        params['DepthManager']['autotuned_minibatch'] = dm.autotuned_minibatch
+        yaml.dump(params, open(os.path.join(result_dir, 'conf.yml'), 'w'))
+
     trainer = Trainer(discriminator, generator, d_loss_fun, g_loss_fun, dataset, get_random_latents(mb_def),
                       train_cur_img, opt_g, opt_d, **params['Trainer'])
     dm = DepthManager(get_dataloader, get_random_latents, max_depth, params['Trainer']['tick_kimg_default'],
                       get_optimizers, params['lr'], **params['DepthManager'])
+    dm.on_autotune = save_config
     trainer.register_plugin(dm)
     for i, loss_name in enumerate(losses):
         trainer.register_plugin(EfficientLossMonitor(i, loss_name, **params['EfficientLossMonitor']))
@@ -221,25 +299,21 @@ def main(params):
             SlicedWDistance(dataset.progression_scale, params['SaverPlugin']['network_snapshot_ticks'],
                             **params['SlicedWDistance']))
     trainer.register_plugin(AbsoluteTimeMonitor())
+    for plugin in extra_plugins:
+        trainer.register_plugin(plugin)
     if params['Generator']['spectral']:
         trainer.register_plugin(WatchSingularValues(generator, **params['WatchSingularValues']))
     if params['Discriminator']['spectral']:
         trainer.register_plugin(WatchSingularValues(discriminator, **params['WatchSingularValues']))
     trainer.register_plugin(logger)
-    params['EEGDataset']['progression_scale_up'] = dataset.progression_scale_up
-    params['EEGDataset']['progression_scale_down'] = dataset.progression_scale_down
-    params['EEGDataset']['picked_channels'] = dataset.picked_channels
-    params['DepthManager']['minibatch_override'] = dm.minibatch_override
-    params['DepthManager']['tick_kimg_override'] = dm.tick_kimg_override
-    params['DepthManager']['training_kimg_override'] = dm.training_kimg_override
-    params['DepthManager']['transition_kimg_override'] = dm.transition_kimg_override
-    yaml.dump(params, open(os.path.join(result_dir, 'conf.yml'), 'w'))
+    save_config()
     trainer.run(params['total_kimg'])
     del trainer
 
 
+need_arg_classes = [Trainer, Generator, Discriminator, Adam, OutputGenerator, DepthManager, SaverPlugin,
+                    SlicedWDistance, EfficientLossMonitor, EvalDiscriminator, EEGDataset, WatchSingularValues]
+
 if __name__ == "__main__":
-    need_arg_classes = [Trainer, Generator, Discriminator, Adam, OutputGenerator, DepthManager, SaverPlugin,
-                        SlicedWDistance, EfficientLossMonitor, EvalDiscriminator, EEGDataset, WatchSingularValues]
     main(parse_config(default_params, need_arg_classes))
     print('training finished!')
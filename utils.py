@@ -11,8 +11,12 @@ import torch.nn.functional as F
 from typing import Dict, TypeVar
 from argparse import ArgumentParser
 
+from resampling import get_resampler, rational_factors
+
 EPSILON = 1e-8
 half_tensor = None
+noise_seeds = random.Random('0-0')
+noise_generators = {}
 
 
 def generate_samples(generator, gen_input):
@@ -38,6 +42,36 @@ def get_half(num_latents, latent_size):
     return half_tensor
 
 
+def set_noise_seed(seed, rank=0):
+    """restarts the seed stream of the stochastic layers, every (data parallel) rank gets its own stream"""
+    global noise_seeds
+    noise_seeds = random.Random('{}-{}'.format(seed, rank))
+
+
+def next_noise_seed():
+    return noise_seeds.getrandbits(63)
+
+
+def get_noise_state():
+    return noise_seeds.getstate()
+
+
+def set_noise_state(state):
+    noise_seeds.setstate(state)
+
+
+def device_randn(size, like, seed=None):
+    """normal noise on the device (and with the dtype) of like, drawn again by passing the same seed"""
+    if torch.jit.is_tracing():  # fresh noise on every call of the traced graph
+        return torch.randn(size, device=like.device, dtype=like.dtype)
+    seed = next_noise_seed() if seed is None else seed
+    device = str(like.device)
+    if device not in noise_generators:
+        noise_generators[device] = torch.Generator(device=like.device)
+    generator = noise_generators[device].manual_seed(seed)
+    return torch.randn(size, generator=generator, device=like.device, dtype=like.dtype)
+
+
 def random_latents(num_latents, latent_size, z_distribution='normal'):
     if z_distribution == 'normal':
         return torch.randn(num_latents, latent_size)
@@ -49,6 +83,17 @@ def random_latents(num_latents, latent_size, z_distribution='normal'):
         raise ValueError()
 
 
+def truncated_normal(u, threshold):
+    """
+    maps uniform samples u to a standard normal truncated to [-threshold, threshold] (inverse transform sampling, so
+    it's vectorized and runs on the device of u), threshold can be a tensor that broadcasts with u
+    """
+    threshold = torch.as_tensor(threshold, dtype=torch.float64, device=u.device)
+    low = torch.special.ndtr(-threshold)
+    u = u.double().clamp(EPSILON, 1 - EPSILON)
+    return torch.special.ndtri(low + u * (1 - 2 * low)).to(torch.get_default_dtype())
+
+
 def mkdir(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -149,7 +194,7 @@ def enable_benchmark():
 
 
 def load_model(model_path, return_all=False):
-    state = torch.load(model_path, map_location='cpu')
+    state = torch.load(model_path, map_location='cpu', weights_only=False)
     if not return_all:
         return state['model']
     return state['model'], state['optimizer'], state['cur_nimg']
@@ -179,11 +224,12 @@ def parse_config(default_params, need_arg_classes, exclude_adam=True, read_cli=T
     if params['config_file']:
         print('loading config_file')
         with open(params['config_file']) as f:
-            params = _update_params(params, yaml.load(f))
+            params = _update_params(params, yaml.load(f, Loader=yaml.FullLoader))
     params = get_structured_params(params)
     random.seed(params['random_seed'])
     np.random.seed(params['random_seed'])
     torch.manual_seed(params['random_seed'])
+    set_noise_seed(params['random_seed'])
     if torch.cuda.is_available():
         torch.cuda.set_device(params['cuda_device'])
         torch.cuda.manual_seed_all(params['random_seed'])
@@ -218,7 +264,11 @@ def expand3d(signal):
     return signal
 
 
-def resample_signal(signal, signal_freq, desired_freq, pytorch=True):
+def resample_signal(signal, signal_freq, desired_freq, pytorch=True, exact=False):
+    """
+    linear upsampling followed by average pooling, tensors with an integral frequency ratio go through a cached
+    polyphase kernel (set exact to use F.interpolate and avg_pool1d instead)
+    """
     if isinstance(signal, np.ndarray):
         new_signal = torch.from_numpy(signal)
     else:
@@ -232,6 +282,10 @@ def resample_signal(signal, signal_freq, desired_freq, pytorch=True):
         ratio = desired_freq / signal_freq
         assert ratio == int(ratio)
         return new_signal.repeat(1, 1, int(ratio))
+    if pytorch and not exact:
+        factors = rational_factors(signal_freq, desired_freq)
+        if factors is not None:
+            return get_resampler(*factors)(new_signal)
     if isinstance(desired_freq, float):
         if desired_freq == int(desired_freq) and signal_freq == int(signal_freq):
             desired_freq = int(desired_freq)